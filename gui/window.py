@@ -1,19 +1,54 @@
 """
 Script for GUI
 """
+import os
+import importlib.util
 from PyQt5 import QtCore, QtGui, uic
 import cv2
 import threading
-from queue import Queue
-from utils.utils import get_frames_concat, set_output_name
+from queue import Queue, Empty
+from utils.utils import get_frames_concat, get_depth_frames, get_capture_time, set_output_name
+from utils.profiling import profiler
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtWidgets import QMainWindow, QMessageBox, QWidget, QApplication, QLineEdit, QLabel, QGridLayout
 
+UI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simple.ui")
+UI_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "simple_ui.py")
+
+
+def load_form_class(ui_path=UI_PATH, cache_path=UI_CACHE_PATH):
+    """
+    Load the form class of a Qt Designer file.
+    The .ui file is compiled to python once and the compiled module is reused until the .ui file changes,
+    which avoids parsing the XML on every start.
+    :param ui_path:         Path to the .ui file
+    :param cache_path:      Path to the compiled python module
+    :return: Form class to inherit from
+    """
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(ui_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Compile to a temporary file first so that a failed compilation never leaves a truncated module in the cache
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                uic.compileUi(ui_path, f)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    spec = importlib.util.spec_from_file_location("simple_ui", cache_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return next(getattr(module, name) for name in dir(module) if name.startswith("Ui_"))
+
+
 # Necessary global variables used to stop and start loops inside threads
 running = False
 recording = False
 video_thread = None
-FormClass = uic.loadUiType("./gui/simple.ui")[0]
+with profiler.section("load UI form"):
+    FormClass = load_form_class()
 q = Queue()
 
 
@@ -189,8 +224,14 @@ def grab_frames(readers, writer):
             # Write this frame in the output video
             # start method is effective on first call only, does nothing afterwards
             writer = writer.start()
-            writer.write_frame(frames_concat)
-
+            writer.write_frame(frames_concat, get_depth_frames(readers), get_capture_time(readers))
+
+        # Drop the oldest frame of a bounded display queue rather than blocking the recording
+        if q.full():
+            try:
+                q.get_nowait()
+            except Empty:
+                pass
         q.put(frames_concat)
 
 
@@ -218,6 +259,22 @@ def start_interface(readers, writer, args) -> None:
     recording = False
 
 
+def set_display_queue_size(size) -> None:
+    """
+    Bound the queue of frames waiting to be displayed, 0 for unbounded.
+    :param size:    Maximum number of frames
+    """
+    global q
+    q = Queue(maxsize=size)
+
+
+def get_display_queue():
+    """
+    :return: Queue of frames waiting to be displayed
+    """
+    return q
+
+
 def stop_interface():
     """
     Stop remaining thread of the graphical interface
@@ -4,13 +4,14 @@ Script for recording videos for dataset construction using Faurecia's buck.
 import argparse
 import os
 import sys
-import json
-import logging as lg
 import time
-from PyQt5 import QtWidgets
-from gui.window import start_interface, stop_interface
-from utils.utils import get_cameras_id, start_readers, create_writer, stop_readers, record, play_vlc
-from utils.automatic_data_collection import get_IMAP, read_last_email, get_messages_nb
+import asyncio
+import functools
+import importlib
+import threading
+import logging as lg
+from pathlib import Path
+from utils.profiling import profiler
 
 parser = argparse.ArgumentParser(description="Video recording script for buck dataset.")
 
@@ -19,6 +20,10 @@ parser.add_argument("--camera", choices=["all", "from_config"],
                          "For the moment, only Real Sense cameras are supported."
                          "TODO: Implement camera loading from config file.")
 parser.add_argument("--time", "-t", help="Max duration of capture in seconds.", type=int, default=60)
+parser.add_argument("--step-timeout", type=float, default=30.,
+                    help="Timeout in seconds of every session step: camera warm-up, writer start, email check.")
+parser.add_argument("--demo-timeout", type=float, default=600.,
+                    help="Timeout in seconds of the demo video.")
 parser.add_argument("--verbose", "-v", help="Run the code in verbose mode.", action='store_true')
 parser.add_argument('--output-prefix',
                     help="Prefix for the output video file. If None is defined, a timestamp will be used.")
@@ -33,6 +38,10 @@ parser.add_argument("--no-sound", help="Deactivate audio speech", action="store_
 parser.add_argument("--no-vid", help="Deactivate demo video", action="store_true")
 parser.add_argument("--video-demo", help="Path to the demo video", default="")
 parser.add_argument("--audio-script", help="Path to the audio script", default="")
+parser.add_argument("--timing-table", help="Csv file with the step,start,end times in seconds of the audio script. "
+                                           "Steps are saved as frame ranges in the timeline of every video.")
+parser.add_argument("--catalog", help="SQLite catalog where sessions are registered. "
+                                      "Default to catalog.sqlite in the output folder.")
 parser.add_argument("--gui", dest="gui", help="Use a Graphical User Interface.", action="store_true")
 parser.add_argument("--no-gui", dest="gui", help="Do not use a Graphical User Interface.", action="store_false")
 parser.add_argument("--mail-check-freq", help="Number of seconds interval to between each email check", default=2,
@@ -40,10 +49,27 @@ parser.add_argument("--mail-check-freq", help="Number of seconds interval to bet
 parser.add_argument("--file-output-name", help="Output name as txt", default="test.txt")
 parser.add_argument("--email-address", help="Address to send emails to")
 parser.add_argument("--passwd", help="password for the email address")
+parser.add_argument("--stall-timeout", type=float, default=2.,
+                    help="Seconds without frames after which a camera is considered stalled and restarted.")
+parser.add_argument("--stall-fill", choices=["repeat", "blank"], default="repeat",
+                    help="Frame inserted in the mosaic while a camera reconnects: last frame or marked blank frame.")
+parser.add_argument("--depth", action="store_true",
+                    help="Also capture the depth stream, saved losslessly as uint16 next to the video.")
+parser.add_argument("--memory-budget", type=int,
+                    help="Memory budget of the frame buffers in MB. Buffers are sized from the resolution and the "
+                         "number of cameras, and the recording does not start if they cannot fit.")
+parser.add_argument("--profile-memory", action="store_true",
+                    help="Sample RSS, top allocators and buffers occupancy during the session and save a report "
+                         "next to the video.")
+parser.add_argument("--profile-startup", help="Print the timing tree of imports and initialization before recording.",
+                    action="store_true")
 parser.set_defaults(display=False, gui=False)
 
 args = parser.parse_args()
 
+if args.profile_startup:
+    profiler.enable()
+
 is_email = args.email_address is not None
 
 if args.verbose:
@@ -52,108 +78,258 @@ if args.verbose:
 else:
     lg.basicConfig(level=lg.INFO)
 
+# Only load the subsystems needed by the selected mode, GUI, VLC and IMAP are slow to import
+with profiler.section("import recording backends"):
+    from utils.utils import get_cameras_id, start_readers, create_writer, stop_readers, record
+    from utils.orchestrator import SessionOrchestrator, run_step, wait_step, play_media, wait_first_frame, \
+        timer_source, email_source
+    from utils.timeline import Timeline, read_timing_table
+    from utils.catalog import register_recording
+    from utils.watchdog import CameraWatchdog
+    from utils.memory import plan_buffers, MemoryProfiler
+if args.display:
+    with profiler.section("import gui"):
+        from gui.window import start_interface, stop_interface, set_display_queue_size, get_display_queue
+if not (args.no_vid and args.no_sound) and not args.display:
+    with profiler.section("import vlc"):
+        # Preload VLC before the first trigger, play_vlc then finds it in the imported modules
+        importlib.import_module("vlc")
+if is_email:
+    with profiler.section("import imap"):
+        from utils.automatic_data_collection import get_IMAP
 
-def main(secs: int, fname: str, mail_action, stored_data=None, stored_hashes=None,
-         imap=None):
-    hashes = stored_hashes if stored_hashes else {}
-    data = stored_data if stored_data else []
-    while True:
-        time.sleep(secs)
-        if not is_email:
-            mail_action()
-        else:
-            nb_messages = get_messages_nb(imap)
-            if nb_messages:
-                em = read_last_email(imap, nb_messages, hashes)
-                if em != -1:
-                    mail_action()
-                    hashes.update({em["hash"]: {em["uuid"],
-                                                em["height"],
-                                                em["weight"]}})
-                    data.append(em)
-                    with open(fname, 'w') as f:
-                        json.dump(data, f)
-                mail_action()
-                hashes.update({em["hash"]: {em["uuid"],
-                                            em["height"],
-                                            em["weight"]}})
-                data.append(em)
-
-                with open(fname, 'w') as f:
-                    json.dump(data, f)
-
-
-def start():
-    player = -1
-    cams = get_cameras_id()
+
+# Frame buffers planned for a given number of cameras, see plan_session_buffers
+buffer_plan = {"cam_number": None, "reader_queue": 64}
+
+
+def discover_cameras():
+    """
+    List the connected cameras, refuse to go on without any.
+    :return: List of cameras serial number
+    """
+    with profiler.section("camera discovery"):
+        cams = get_cameras_id()
+    if not cams:
+        raise Exception("No RealSense camera found, please check the connections")
+
+    return cams
+
+
+def plan_session_buffers(cam_number) -> int:
+    """
+    Size frame buffers from the memory budget, refuse to start if they cannot fit.
+    The plan is only computed again when the number of cameras changes.
+    :param cam_number:      Number of cameras
+    :return: Size of every reader queue
+    """
+    if args.memory_budget and buffer_plan["cam_number"] != cam_number:
+        plan = plan_buffers(args.memory_budget, cam_number, args.input_width, args.input_height, args.display,
+                            args.depth)
+        buffer_plan.update(cam_number=cam_number, reader_queue=plan["reader_queue"])
+        if args.display:
+            set_display_queue_size(plan["display_queue"])
+
+    return buffer_plan["reader_queue"]
+
+
+def warm_up(timeline):
+    """
+    Start cameras, their watchdog and create the writer of one session.
+    :param timeline:        Session timeline given to the writer
+    :return: (readers, writer, watchdog) tuple
+    """
+    cams = discover_cameras()
+    queue_size = plan_session_buffers(len(cams))
 
     # Start cameras readers
-    readers = start_readers(cams, args.input_width, args.input_height, args.cam_fps)
-
-    # Start writer
-    writer = create_writer(
-        args.output_prefix,
-        args.output_folder,
-        len(cams),
-        args.cam_fps,
-        args.input_width,
-        args.input_height
-    )
+    with profiler.section("start readers"):
+        readers = start_readers(cams, args.input_width, args.input_height, args.cam_fps, args.stall_fill,
+                                queue_size, args.depth)
+    # Restart stalled cameras in the background
+    watchdog = CameraWatchdog(readers, args.stall_timeout).start()
+
+    # Create writer
+    with profiler.section("create writer"):
+        writer = create_writer(
+            args.output_prefix,
+            args.output_folder,
+            len(cams),
+            args.cam_fps,
+            args.input_width,
+            args.input_height,
+            timeline,
+            read_timing_table(args.timing_table) if args.timing_table else None,
+            args.depth
+        )
 
+    return readers, writer, watchdog
+
+
+def start_memory_profiler(readers, writer):
+    """
+    Start sampling the memory usage and the occupancy of every frame buffer.
+    :param readers:         Dict of video reader threads
+    :param writer:          Video writer thread
+    :return: MemoryProfiler
+    """
+    buffers = {name: (lambda queue=reader.queue: (queue.qsize(), queue.maxsize))
+               for name, reader in readers.items()}
+    buffers["writer"] = lambda: (int(writer.frame is not None), 1)
+    if args.depth:
+        buffers["depth"] = lambda: ((writer.depth_writer.queue.qsize(), writer.depth_writer.queue.maxsize)
+                                    if writer.depth_writer is not None else (0, 0))
     if args.display:
-        lg.info('Starting interface')
-        start_interface(readers, writer, args)
-        lg.info("Interface closed")
-    else:
-        lg.debug('Interface disabled')
-        lg.debug("Start demo video")
-        if not args.no_vid:
-            if os.path.exists(args.video_demo):
-                # use wait to wait for the explaination to end before recording
-                player = play_vlc(path=args.video_demo, wait=True)
-            else:
+        buffers["display"] = lambda: (get_display_queue().qsize(), get_display_queue().maxsize)
+
+    return MemoryProfiler(buffers).start()
+
+
+async def session(participant=None, trigger_time=None):
+    """
+    Record one session. Camera warm-up runs during the demo video, then the audio script and the writer start
+    together. The recording lasts --time seconds, and everything is shut down in order even when cancelled.
+    :param participant:     Participant dict read from the emails, registered in the catalog with the session
+    :param trigger_time:    Monotonic time of the trigger, used to log the latency to the first recorded frame
+    """
+    trigger_time = trigger_time if trigger_time is not None else time.monotonic()
+    player = None
+    readers = writer = watchdog = memory_profiler = None
+    stop_event = threading.Event()
+    recording = None
+
+    # Session timeline aligning the audio script with the recorded frames
+    timeline = Timeline()
+    # Keep the executor future itself: the warm-up thread goes on after a timeout and what it starts must be stopped
+    warm_up_start = time.monotonic()
+    cameras = asyncio.get_event_loop().run_in_executor(None, warm_up, timeline)
+    try:
+        if not args.display and not args.no_vid:
+            lg.debug("Start demo video")
+            if not os.path.exists(args.video_demo):
                 raise Exception("Invalid demo video path")
-        lg.debug("Start script audio")
+            # Wait for the explanation to end before recording
+            timeline.mark("demo_start")
+            player = await play_media(args.video_demo, wait=True, timeout=args.demo_timeout)
+
+        readers, writer, watchdog = await wait_step("camera warm-up", cameras, args.step_timeout, warm_up_start)
+        profiler.report()
+        if args.profile_memory:
+            memory_profiler = start_memory_profiler(readers, writer)
+
+        if args.display:
+            # Qt runs in the main thread, triggers are paused until the window is closed
+            lg.info('Starting interface')
+            start_interface(readers, writer, args)
+            lg.info("Interface closed")
+            return
+
+        lg.debug('Interface disabled')
+        steps = [run_step("writer start", writer.start, timeout=args.step_timeout)]
         if not args.no_sound:
-            if os.path.exists(args.audio_script):
-                # Dont use wait to start recording while the instructions are playing
-                player = play_vlc(path=args.audio_script, wait=False)
-            else:
+            lg.debug("Start script audio")
+            if not os.path.exists(args.audio_script):
                 raise Exception("Invalid audio script path")
+            # Dont wait to start recording while the instructions are playing
+            steps.append(play_media(args.audio_script, wait=False))
+        results = await asyncio.gather(*steps)
+        if not args.no_sound:
+            player = results[1]
+            timeline.attach_player(player)
+
         lg.debug("start recording")
-        record(readers, writer)
+        recording = asyncio.get_event_loop().run_in_executor(None, record, readers, writer, stop_event)
+        await wait_first_frame(writer, args.step_timeout)
+        lg.info(f"Trigger to first recorded frame: {time.monotonic() - trigger_time:.3f}s")
+        try:
+            await asyncio.wait_for(asyncio.shield(recording), args.time)
+        except asyncio.TimeoutError:
+            lg.info(f"Max duration of {args.time}s reached")
+    finally:
+        stop_event.set()
+        try:
+            if recording is not None:
+                await recording
+        finally:
+            if readers is None and cameras.done():
+                # Startup failed or was cancelled after the warm-up ended, stop what it started
+                readers, writer, watchdog = get_warm_up_result(cameras)
+            elif readers is None:
+                # The warm-up is still running, possibly hung: do not wait for it, stop what it started once it ends
+                lg.warning("Camera warm-up still running, its cameras will be stopped when it ends")
+                cameras.add_done_callback(stop_warm_up)
+            shutdown(writer, readers, player, participant, watchdog, memory_profiler)
+
+
+def get_warm_up_result(future):
+    """
+    Result of a finished camera warm-up.
+    :param future:          Future of warm_up
+    :return: (readers, writer, watchdog) tuple, Nones if the warm-up failed
+    """
+    if future.cancelled() or future.exception() is not None:
+        if not future.cancelled():
+            lg.debug(f"Camera warm-up failed: {future.exception()}")
+        return None, None, None
 
-    shutdown(writer, readers, player)
+    return future.result()
 
 
-def shutdown(writer, readers, player=None):
+def stop_warm_up(future) -> None:
+    """
+    Done callback of a warm-up abandoned by its session, shutting down what it started in an executor thread.
+    :param future:          Future of warm_up
+    """
+    readers, writer, watchdog = get_warm_up_result(future)
+    if readers is not None:
+        asyncio.get_event_loop().run_in_executor(None, shutdown, writer, readers, None, None, watchdog)
+
+
+def shutdown(writer, readers, player=None, participant=None, watchdog=None, memory_profiler=None):
     """
     Helper function that closes all threads, video writers and close all windows
     :param writer:          Video writer thread
     :param readers:         Dict of video reader threads
     :param player:          Vlc player
+    :param participant:     Participant dict registered in the catalog with the session
+    :param watchdog:        Camera watchdog thread
+    :param memory_profiler: Memory profiler thread, its report is saved next to the video
     """
     lg.warning("Stopping thread and writers")
+    if watchdog:
+        watchdog.stop()
     if writer:
         writer.stop()
     if readers:
         stop_readers(readers)
-    player.stop()
+    if writer and writer.frame_count:
+        register_recording(args.catalog if args.catalog else str(Path(args.output_folder) / "catalog.sqlite"),
+                           writer, readers, args.input_width, args.input_height, participant)
+    if memory_profiler:
+        memory_profiler.write_report(os.path.splitext(writer.video_file_name)[0] + "_memory.txt")
+    if player is not None and player != -1:
+        player.stop()
 
 
 if __name__ == '__main__':
+    # Check cameras and the memory budget once at launch rather than when the first participant arrives
+    plan_session_buffers(len(discover_cameras()))
     try:
-        main(
-            args.mail_check_freq,
-            args.file_output_name,
-            start,
-            imap=get_IMAP(f"{args.email_address}", f"{args.passwd}") if is_email else None
-        )
+        if is_email:
+            with profiler.section("imap login"):
+                imap = get_IMAP(f"{args.email_address}", f"{args.passwd}")
+            sources = [functools.partial(email_source, imap=imap, period=args.mail_check_freq,
+                                         fname=args.file_output_name, timeout=args.step_timeout)]
+        else:
+            sources = [functools.partial(timer_source, period=args.mail_check_freq)]
+        SessionOrchestrator(session, sources).run_forever()
     except KeyboardInterrupt:
         lg.critical("Keyboard Interrupt")
         try:
-            stop_interface()
-            QtWidgets.QApplication.exit()
+            if args.display:
+                from PyQt5 import QtWidgets
+                stop_interface()
+                QtWidgets.QApplication.exit()
             sys.exit(0)
         except SystemExit:
             os._exit(0)
@@ -1,9 +1,15 @@
+import os
+import re
+import json
 import logging as lg
 import email
 import imaplib
 import uuid
 from hashlib import sha1
 
+# Only the headers needed to identify a registration are downloaded, PEEK keeps messages unread
+HEADER_QUERY = "(BODY.PEEK[HEADER.FIELDS (SUBJECT DATE FROM)])"
+
 
 def get_IMAP(username: str, psswd: str,
              host: str = "imap.gmail.com",
@@ -33,9 +39,9 @@ def read_subject_mail(imap, nb_messages):
             sender = cur_email["From"]
             h.update((date + sender).encode())
             cur_uuid = str(uuid.uuid4())
-            data[h.hexdigest] = {"uuid": cur_uuid,
-                                 "heigth": height,
-                                 "weight": weight}
+            data[h.hexdigest()] = {"uuid": cur_uuid,
+                                   "height": height,
+                                   "weight": weight}
     return data
 
 
@@ -59,3 +65,123 @@ def read_last_email(imap, nb_messages, hashes):
             return -1
 
 
+def parse_registration(headers):
+    """
+    Read a registration from email headers. The subject is "<height>,<weight>".
+    :param headers:     Raw headers as bytes
+    :return: Dict with hash, height and weight keys, None if the email is not a registration
+    """
+    cur_email = email.message_from_bytes(headers)
+    subj, date, sender = cur_email["Subject"], cur_email["Date"], cur_email["From"]
+    if subj is None or date is None or sender is None:
+        return None
+    try:
+        height, weight = list(map(int, subj.split(",")))
+    except ValueError:
+        return None
+    h = sha1()
+    h.update((date + sender).encode())
+
+    return {"hash": h.hexdigest(), "height": height, "weight": weight}
+
+
+def get_uidvalidity(imap):
+    """
+    Select the INBOX and read its UIDVALIDITY. UIDs of a previous check are only valid while it does not change.
+    :param imap:            IMAP connection
+    :return: UIDVALIDITY as int, None if the server did not send it
+    """
+    imap.select("INBOX")
+    _, data = imap.response("UIDVALIDITY")
+
+    return int(data[-1]) if data and data[-1] is not None else None
+
+
+def search_uids(imap, first_uid):
+    """
+    List the UIDs of the messages received since a UID.
+    :param imap:            IMAP connection with the INBOX selected
+    :param first_uid:       First UID to list
+    :return: Sorted list of UIDs
+    """
+    _, data = imap.uid("SEARCH", None, f"UID {first_uid}:*")
+    # "n:*" always matches the last message, even when its UID is lower than n
+    return sorted(uid for uid in map(int, data[0].split()) if uid >= first_uid)
+
+
+def fetch_registrations(imap, uids, batch_size=500):
+    """
+    Fetch the registration headers of messages, with one UID FETCH command per batch of messages.
+    Works with any object implementing imaplib's uid, e.g utils.local_imap.LocalIMAP.
+    :param imap:            IMAP connection with the INBOX selected
+    :param uids:            Sorted list of message UIDs
+    :param batch_size:      Number of messages per FETCH command
+    :return: List of (UID, registration) tuples in arrival order
+    """
+    registrations = []
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        _, msg = imap.uid("FETCH", f"{batch[0]}:{batch[-1]}", HEADER_QUERY)
+        for response in msg:
+            # Responses are (b"<seq> (UID <uid> BODY[...] {size}", headers) tuples separated by b")"
+            if not isinstance(response, tuple):
+                continue
+            uid = int(re.search(rb"UID (\d+)", response[0]).group(1))
+            registration = parse_registration(response[1])
+            if registration is not None:
+                registrations.append((uid, registration))
+
+    return sorted(registrations, key=lambda registration: registration[0])
+
+
+def backfill_registrations(imap, hashes, cursor=None, batch_size=500):
+    """
+    Read every registration received since the previous check and keep the unseen ones.
+    Messages are identified by UID, so deleting messages does not hide new ones.
+    :param imap:            IMAP connection
+    :param hashes:          Hashes of the registrations already seen, not modified
+    :param cursor:          (UIDVALIDITY, next UID) returned by the previous check, None to read the whole inbox
+    :param batch_size:      Number of messages per FETCH command
+    :return: (new registrations in arrival order, cursor of the next check)
+    """
+    uidvalidity = get_uidvalidity(imap)
+    # UIDs of another mailbox generation are meaningless: read everything again, hashes avoid duplicates
+    first_uid = cursor[1] if cursor is not None and cursor[0] == uidvalidity else 1
+    uids = search_uids(imap, first_uid)
+    new = []
+    new_hashes = set()
+    for _, registration in fetch_registrations(imap, uids, batch_size):
+        if registration["hash"] in hashes or registration["hash"] in new_hashes:
+            continue
+        registration["uuid"] = str(uuid.uuid4())
+        new_hashes.add(registration["hash"])
+        new.append(registration)
+    if new:
+        lg.info(f"{len(new)} new registrations")
+
+    return new, (uidvalidity, uids[-1] + 1 if uids else first_uid)
+
+
+def load_registrations(fname):
+    """
+    Load the registrations saved by previous runs.
+    :param fname:       Json file of registrations
+    :return: List of registration dicts
+    """
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_registrations(fname, data) -> None:
+    """
+    Save registrations atomically, so that a crash while writing never corrupts the file.
+    :param fname:       Json file of registrations
+    :param data:        List of registration dicts
+    """
+    tmp_name = fname + ".tmp"
+    with open(tmp_name, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_name, fname)
+
@@ -0,0 +1,241 @@
+"""
+Local SQLite catalog of the dataset linking participants, sessions, cameras and protocol segments.
+Sessions are registered automatically at the end of every recording by main.py.
+
+Query it from the command line, e.g. every session at 60 fps with less than 0.1% of dropped frames:
+
+    python -m utils.catalog videos/catalog.sqlite --fps 60 --max-drop-rate 0.001
+"""
+import os
+import time
+import sqlite3
+import argparse
+import logging as lg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    uuid TEXT PRIMARY KEY,
+    email_hash TEXT UNIQUE,
+    height INTEGER,
+    weight INTEGER
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    participant_uuid TEXT REFERENCES participants(uuid),
+    video_file TEXT NOT NULL UNIQUE,
+    timeline_file TEXT,
+    recorded_at INTEGER NOT NULL,
+    fps INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    cam_number INTEGER NOT NULL,
+    frame_count INTEGER NOT NULL,
+    dropped_frames INTEGER NOT NULL,
+    drop_rate REAL NOT NULL,
+    depth_folder TEXT,
+    depth_dropped_frames INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cameras (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    serial TEXT NOT NULL,
+    frame_count INTEGER NOT NULL,
+    dropped_frames INTEGER NOT NULL,
+    PRIMARY KEY (session_id, serial)
+);
+CREATE TABLE IF NOT EXISTS segments (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    step TEXT NOT NULL,
+    first_frame INTEGER NOT NULL,
+    last_frame INTEGER NOT NULL,
+    PRIMARY KEY (session_id, step)
+);
+CREATE INDEX IF NOT EXISTS sessions_fps_drop ON sessions(fps, drop_rate);
+CREATE INDEX IF NOT EXISTS sessions_resolution ON sessions(width, height);
+CREATE INDEX IF NOT EXISTS sessions_participant ON sessions(participant_uuid);
+CREATE INDEX IF NOT EXISTS sessions_recorded_at ON sessions(recorded_at);
+CREATE INDEX IF NOT EXISTS cameras_serial ON cameras(serial);
+CREATE INDEX IF NOT EXISTS segments_step ON segments(step);
+"""
+# Columns added to the sessions table after its creation, added to older catalogs when opened
+SESSION_COLUMNS = {
+    "depth_folder": "TEXT",
+    "depth_dropped_frames": "INTEGER NOT NULL DEFAULT 0"
+}
+
+
+def connect(db_path) -> sqlite3.Connection:
+    """
+    Open the catalog, creating its tables and indexes if needed.
+    :param db_path:     Path to the SQLite file
+    :return: sqlite3 connection
+    """
+    con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA foreign_keys = ON")
+    con.executescript(SCHEMA)
+    columns = {row["name"] for row in con.execute("PRAGMA table_info(sessions)")}
+    with con:
+        for column, definition in SESSION_COLUMNS.items():
+            if column not in columns:
+                con.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+
+    return con
+
+
+def register_session(db_path, video_file, fps, width, height, frame_count, dropped_frames, cameras,
+                     segments=None, participant=None, timeline_file=None, depth_folder=None,
+                     depth_dropped_frames=0) -> int:
+    """
+    Insert one recording session in the catalog.
+    :param db_path:             Path to the SQLite file
+    :param video_file:          Path to the recorded mosaic
+    :param fps:                 FPS of the recording
+    :param width:               Width of every single video stream
+    :param height:              Height of every single video stream
+    :param frame_count:         Number of frames written in the video
+    :param dropped_frames:      Number of frames lost during the session
+    :param cameras:             List of (serial, frame_count, dropped_frames) tuples
+    :param segments:            List of (step, first_frame, last_frame) tuples
+    :param participant:         Participant dict with uuid, height, weight and hash keys, as read from the emails
+    :param timeline_file:       Path to the timeline index of the video
+    :param depth_folder:        Folder of the uint16 depth chunks of the video, None without depth
+    :param depth_dropped_frames: Number of mosaic frames whose depth was dropped by the DepthWriter
+    :return: Id of the session
+    """
+    total = frame_count + dropped_frames
+    with connect(db_path) as con:
+        participant_uuid = None
+        if participant:
+            participant_uuid = participant["uuid"]
+            con.execute("INSERT OR IGNORE INTO participants (uuid, email_hash, height, weight) VALUES (?, ?, ?, ?)",
+                        (participant_uuid, participant.get("hash"), participant.get("height"),
+                         participant.get("weight")))
+        cur = con.execute(
+            "INSERT INTO sessions (participant_uuid, video_file, timeline_file, recorded_at, fps, width, height, "
+            "cam_number, frame_count, dropped_frames, drop_rate, depth_folder, depth_dropped_frames) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (participant_uuid, os.path.abspath(video_file), timeline_file, int(time.time()), fps, width, height,
+             len(cameras), frame_count, dropped_frames, dropped_frames / total if total else 0.,
+             os.path.abspath(depth_folder) if depth_folder else None, depth_dropped_frames)
+        )
+        session_id = cur.lastrowid
+        con.executemany("INSERT INTO cameras (session_id, serial, frame_count, dropped_frames) VALUES (?, ?, ?, ?)",
+                        [(session_id, *camera) for camera in cameras])
+        con.executemany("INSERT INTO segments (session_id, step, first_frame, last_frame) VALUES (?, ?, ?, ?)",
+                        [(session_id, *segment) for segment in (segments or [])])
+    con.close()
+    lg.info(f"Session {session_id} registered in {db_path}")
+
+    return session_id
+
+
+def register_recording(db_path, writer, readers, input_width, input_height, participant=None) -> int:
+    """
+    Register a finished recording using the counters of its writer and readers.
+    Dropped frames are the frames overwritten before being written plus the largest gap count of the cameras.
+    :param db_path:             Path to the SQLite file
+    :param writer:              Stopped video Writer
+    :param readers:             Dict of ReaderRealSense
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :param participant:         Participant dict as read from the emails
+    :return: Id of the session
+    """
+    # Imported here to keep the query command line free of numpy and OpenCV
+    from utils.timeline import TimelineIndex, get_timeline_name
+
+    # Substitute frames inserted while a camera was stalled are counted as dropped for this camera
+    cameras = [(reader.serial_number, reader.frame_count, reader.dropped_frames + reader.lost_frames)
+               for reader in readers.values()]
+    index = TimelineIndex.load(writer.video_file_name)
+    depth_writer = writer.depth_writer
+    segments = [(step, first, last) for step, (first, last) in index.steps.items()] if index is not None else []
+
+    return register_session(
+        db_path,
+        writer.video_file_name,
+        writer.fps,
+        input_width,
+        input_height,
+        writer.frame_count,
+        writer.dropped_frames + max((dropped for _, _, dropped in cameras), default=0),
+        cameras,
+        segments,
+        participant,
+        get_timeline_name(writer.video_file_name) if index is not None else None,
+        depth_writer.folder if depth_writer is not None else None,
+        depth_writer.dropped_frames if depth_writer is not None else 0
+    )
+
+
+def query_sessions(db_path, fps=None, max_drop_rate=None, width=None, height=None, participant=None, serial=None,
+                   step=None):
+    """
+    Select sessions matching every given filter.
+    :param db_path:             Path to the SQLite file
+    :param fps:                 Exact FPS of the session
+    :param max_drop_rate:       Maximum ratio of dropped frames, excluded
+    :param width:               Width of every single video stream
+    :param height:              Height of every single video stream
+    :param participant:         Participant uuid
+    :param serial:              Serial number of a camera used in the session
+    :param step:                Protocol step present in the session
+    :return: List of sqlite3.Row
+    """
+    clauses, params = [], []
+    for column, value in (("fps", fps), ("width", width), ("height", height), ("participant_uuid", participant)):
+        if value is not None:
+            clauses.append(f"s.{column} = ?")
+            params.append(value)
+    if max_drop_rate is not None:
+        clauses.append("s.drop_rate < ?")
+        params.append(max_drop_rate)
+    if serial is not None:
+        clauses.append("EXISTS (SELECT 1 FROM cameras c WHERE c.session_id = s.id AND c.serial = ?)")
+        params.append(serial)
+    if step is not None:
+        clauses.append("EXISTS (SELECT 1 FROM segments g WHERE g.session_id = s.id AND g.step = ?)")
+        params.append(step)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    con = connect(db_path)
+    rows = con.execute(f"SELECT s.* FROM sessions s {where} ORDER BY s.recorded_at", params).fetchall()
+    con.close()
+
+    return rows
+
+
+def get_session_by_video(db_path, video_file):
+    """
+    Select the session of a recorded video.
+    :param db_path:             Path to the SQLite file
+    :param video_file:          Path to the recorded mosaic
+    :return: sqlite3.Row or None if the video is not in the catalog
+    """
+    con = connect(db_path)
+    row = con.execute("SELECT * FROM sessions WHERE video_file = ?", (os.path.abspath(video_file),)).fetchone()
+    con.close()
+
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the catalog of recorded sessions.")
+    parser.add_argument("catalog", help="Path to the SQLite catalog.")
+    parser.add_argument("--fps", type=int, help="FPS of the sessions.")
+    parser.add_argument("--max-drop-rate", type=float, help="Maximum ratio of dropped frames, e.g 0.001 for 0.1%%.")
+    parser.add_argument("--input-width", "-iw", type=int, help="Width of every single video stream.")
+    parser.add_argument("--input-height", "-ih", type=int, help="Height of every single video stream.")
+    parser.add_argument("--participant", help="Participant uuid.")
+    parser.add_argument("--serial", help="Serial number of a camera used in the session.")
+    parser.add_argument("--step", help="Protocol step recorded in the session.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.catalog):
+        raise Exception(f"Catalog {args.catalog} does not exist")
+
+    for row in query_sessions(args.catalog, args.fps, args.max_drop_rate, args.input_width, args.input_height,
+                              args.participant, args.serial, args.step):
+        print(f"{row['id']}\t{row['video_file']}\t{row['participant_uuid']}\t{row['fps']}fps\t"
+              f"{row['width']}x{row['height']}\t{row['frame_count']} frames\t{row['drop_rate']:.4%} dropped"
+              + (f"\t{row['depth_dropped_frames']} depth frames dropped" if row['depth_folder'] else ""))
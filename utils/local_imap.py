@@ -0,0 +1,163 @@
+"""
+In-memory IMAP stand-in implementing the part of imaplib.IMAP4 used by utils.automatic_data_collection, to check the
+registration backfill without a mail server.
+
+Run it as a script to time a backfill and check that registrations are neither skipped nor duplicated when messages
+are deleted and new ones arrive, e.g with 3000 messages and 20 ms per IMAP command:
+
+    python -m utils.local_imap --messages 3000 --latency 0.02
+"""
+import re
+import sys
+import time
+import argparse
+import logging as lg
+from email.utils import formatdate
+
+UIDVALIDITY = 1
+
+
+class LocalIMAP:
+    """
+    Class storing messages in memory and answering select, response, fetch and uid commands like imaplib.
+    Every command waits for latency seconds to simulate a round trip, and commands are counted.
+    """
+
+    def __init__(self, latency=0.):
+        """
+        :param latency:     Duration of every command in seconds
+        """
+        self.latency = latency
+        self.uidvalidity = UIDVALIDITY
+        # Messages in arrival order as (uid, raw headers) tuples, sequence numbers are positions in this list
+        self.messages = []
+        self.next_uid = 1
+        self.responses = {}
+        self.commands = 0
+
+    def add_message(self, subject, sender, date=None) -> int:
+        """
+        Deliver a message to the INBOX.
+        :param subject:     Subject of the message
+        :param sender:      From header
+        :param date:        Date header, defaults to now
+        :return: UID of the message
+        """
+        date = date if date is not None else formatdate()
+        headers = f"Subject: {subject}\r\nDate: {date}\r\nFrom: {sender}\r\n\r\n".encode()
+        self.messages.append((self.next_uid, headers))
+        self.next_uid += 1
+
+        return self.next_uid - 1
+
+    def delete_messages(self, uids) -> None:
+        """
+        Delete and expunge messages, sequence numbers of the following messages change.
+        :param uids:        UIDs of the messages to delete
+        """
+        uids = set(uids)
+        self.messages = [message for message in self.messages if message[0] not in uids]
+
+    def command(self) -> None:
+        """
+        Count a command and simulate its round trip
+        """
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def select(self, mailbox="INBOX"):
+        self.command()
+        self.responses["UIDVALIDITY"] = [str(self.uidvalidity).encode()]
+        self.responses["UIDNEXT"] = [str(self.next_uid).encode()]
+
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        return code, self.responses.pop(code, [None])
+
+    def fetch(self, message_set, message_parts):
+        self.command()
+        indexes = self.parse_set(message_set, len(self.messages))
+
+        return "OK", self.fetch_response([(seq, self.messages[seq - 1]) for seq in indexes])
+
+    def uid(self, command, *args):
+        self.command()
+        seqs = {uid: seq for seq, (uid, _) in enumerate(self.messages, 1)}
+        last_uid = self.messages[-1][0] if self.messages else 0
+        if command.upper() == "SEARCH":
+            uid_set = re.match(r"UID (\S+)", args[-1]).group(1)
+            uids = [uid for uid in self.parse_set(uid_set, last_uid) if uid in seqs]
+            return "OK", [" ".join(map(str, uids)).encode()]
+        if command.upper() == "FETCH":
+            uids = [uid for uid in self.parse_set(args[0], last_uid) if uid in seqs]
+            return "OK", self.fetch_response([(seqs[uid], self.messages[seqs[uid] - 1]) for uid in uids])
+        raise Exception(f"Command {command} is not supported by LocalIMAP")
+
+    @staticmethod
+    def parse_set(message_set, last):
+        """
+        Expand an IMAP message set such as "1:5,8,10:*".
+        :param message_set:     Message set as str
+        :param last:            Value of *
+        :return: Sorted list of numbers
+        """
+        numbers = set()
+        for part in message_set.split(","):
+            bounds = [last if bound == "*" else int(bound) for bound in part.split(":")]
+            numbers.update(range(min(bounds), max(bounds) + 1))
+
+        return sorted(numbers)
+
+    @staticmethod
+    def fetch_response(messages):
+        """
+        Format header fetch responses as returned by imaplib.
+        :param messages:    List of (sequence number, (uid, raw headers)) tuples
+        :return: List of (description, headers) tuples each followed by b")"
+        """
+        response = []
+        for seq, (uid, headers) in messages:
+            response.append((f"{seq} (UID {uid} BODY[HEADER.FIELDS (SUBJECT DATE FROM)] {{{len(headers)}}}".encode(),
+                             headers))
+            response.append(b")")
+
+        return response
+
+
+if __name__ == '__main__':
+    from utils.automatic_data_collection import backfill_registrations
+
+    parser = argparse.ArgumentParser(description="Check the registration backfill against an in-memory IMAP server.")
+    parser.add_argument("--messages", type=int, default=3000, help="Number of registrations in the INBOX.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Duration of every IMAP command in seconds.")
+    parser.add_argument("--batch-size", type=int, default=500, help="Number of messages per FETCH command.")
+    args = parser.parse_args()
+
+    lg.basicConfig(level=lg.INFO)
+
+    imap = LocalIMAP(args.latency)
+    for i in range(args.messages):
+        imap.add_message(f"{150 + i % 50},{50 + i % 40}", f"participant{i}@example.com", formatdate(i))
+    # Messages that are not registrations are ignored
+    imap.add_message("Hello", "someone@example.com")
+
+    start = time.perf_counter()
+    new, cursor = backfill_registrations(imap, set(), batch_size=args.batch_size)
+    lg.info(f"Backfill of {len(new)} registrations in {time.perf_counter() - start:.2f}s "
+            f"with {imap.commands} IMAP commands")
+    hashes = {em["hash"] for em in new}
+
+    # Delete a few old messages while new registrations arrive: sequence numbers shift but UIDs do not
+    imap.delete_messages(uid for uid, _ in imap.messages[:10])
+    for i in range(args.messages, args.messages + 5):
+        imap.add_message(f"{150 + i % 50},{50 + i % 40}", f"participant{i}@example.com", formatdate(i))
+    arrived, cursor = backfill_registrations(imap, hashes, cursor, args.batch_size)
+    lg.info(f"{len(arrived)} registrations after deleting 10 messages and receiving 5")
+
+    ok = len(new) == args.messages and len(hashes) == args.messages and len(arrived) == 5 and \
+        not hashes & {em["hash"] for em in arrived}
+    if not ok:
+        lg.error("Registrations were skipped or duplicated")
+    sys.exit(0 if ok else 1)
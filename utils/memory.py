@@ -0,0 +1,187 @@
+"""
+Memory budget of the frame buffers and memory profiling of a session.
+"""
+import os
+import time
+import tracemalloc
+import logging as lg
+from threading import Thread
+
+MB = 1024 * 1024
+# Frames owned outside of the queues: the mosaic being assembled and the one waiting in the writer
+IN_FLIGHT_MOSAICS = 2
+MIN_READER_QUEUE = 2
+MAX_READER_QUEUE = 64
+DISPLAY_QUEUE = 2
+
+
+def get_depth_bytes(input_width, input_height):
+    """
+    Size of one uint16 depth frame.
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :return: Size in bytes
+    """
+    return input_height * input_width * 2
+
+
+def get_frame_bytes(input_width, input_height, depth=False):
+    """
+    Size of one frame stored in a reader queue: RGB and NIR stacked horizontally, 3 channels each,
+    plus the depth frame if enabled.
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :param depth:               Whether depth is captured
+    :return: Size in bytes
+    """
+    return input_height * input_width * 2 * 3 + (get_depth_bytes(input_width, input_height) if depth else 0)
+
+
+def get_available_memory():
+    """
+    Memory available on the system according to /proc/meminfo.
+    :return: Size in bytes, None if unknown
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def plan_buffers(budget_mb, cam_number, input_width, input_height, display=False, depth=False, depth_buffer=64):
+    """
+    Size every frame buffer of a session so that their worst case footprint fits in a memory budget.
+    :param budget_mb:           Memory budget of the frame buffers in MB
+    :param cam_number:          Number of cameras
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :param display:             Whether frames are also queued for the GUI
+    :param depth:               Whether depth is captured
+    :param depth_buffer:        Number of depth frames per camera held by the DepthWriter queue and chunks
+    :return: Dict with reader_queue and display_queue sizes and the planned footprint in bytes
+    """
+    if cam_number <= 0:
+        raise Exception("No camera found, frame buffers cannot be planned")
+    budget = budget_mb * MB
+    mosaic_bytes = cam_number * get_frame_bytes(input_width, input_height, depth)
+    display_queue = DISPLAY_QUEUE if display else 0
+    # Each slot of the reader queues holds one frame per camera, i.e one mosaic
+    fixed = (IN_FLIGHT_MOSAICS + display_queue + (1 if display else 0)) * mosaic_bytes
+    if depth:
+        fixed += depth_buffer * cam_number * get_depth_bytes(input_width, input_height)
+    reader_queue = min(MAX_READER_QUEUE, (budget - fixed) // mosaic_bytes)
+    if reader_queue < MIN_READER_QUEUE:
+        required = (fixed + MIN_READER_QUEUE * mosaic_bytes) / MB
+        raise Exception(f"Memory budget of {budget_mb} MB is too small for {cam_number} cameras at "
+                        f"{input_width}x{input_height}, at least {required:.0f} MB are required")
+    plan = {
+        "reader_queue": int(reader_queue),
+        "display_queue": display_queue,
+        "bytes": fixed + reader_queue * mosaic_bytes
+    }
+
+    available = get_available_memory()
+    if available is not None and plan["bytes"] > available:
+        raise Exception(f"Planned frame buffers need {plan['bytes'] / MB:.0f} MB but only "
+                        f"{available / MB:.0f} MB are available")
+    lg.info(f"Frame buffers: {plan['reader_queue']} frames per camera, {plan['display_queue']} for display, "
+            f"{plan['bytes'] / MB:.0f} MB at most")
+
+    return plan
+
+
+def get_rss():
+    """
+    Resident set size of the current process.
+    :return: Size in bytes
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryProfiler:
+    """
+    Class that samples the RSS and the occupancy of frame buffers with a dedicated thread,
+    and traces python allocations with tracemalloc, to write a report at the end of a session.
+    """
+
+    def __init__(self, buffers, period=1., top=10):
+        """
+        :param buffers:     Dict of buffer name to a callable returning (occupancy, capacity), capacity 0 if unbounded
+        :param period:      Interval in seconds between two samples
+        :param top:         Number of allocators listed in the report
+        """
+        self.buffers = buffers
+        self.period = period
+        self.top = top
+        self.samples = []
+        self.stopped = False
+        self.thread = None
+        self.start_time = None
+
+    def start(self):
+        """
+        Start tracing allocations and the sampling thread
+        :return: MemoryProfiler class
+        """
+        tracemalloc.start()
+        self.start_time = time.monotonic()
+        self.thread = Thread(target=self.sample, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Set to TRUE the stopped attribute to stop de main loop
+        """
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+
+    def sample(self):
+        """
+        Loop until the thread stop to sample memory usage
+        """
+        while not self.stopped:
+            self.samples.append((time.monotonic() - self.start_time, get_rss(),
+                                 {name: occupancy() for name, occupancy in self.buffers.items()}))
+            time.sleep(self.period)
+
+    def write_report(self, path) -> None:
+        """
+        Stop profiling and write the report.
+        :param path:    Output path of the text report
+        """
+        self.stop()
+        snapshot = tracemalloc.take_snapshot()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        lines = ["# Memory profile", ""]
+        if self.samples:
+            rss = [sample[1] for sample in self.samples]
+            lines.append(f"RSS: peak {max(rss) / MB:.1f} MB, mean {sum(rss) / len(rss) / MB:.1f} MB, "
+                         f"{len(rss)} samples every {self.period}s")
+        lines.append(f"Python allocations: current {traced / MB:.1f} MB, peak {traced_peak / MB:.1f} MB")
+        lines += ["", "## Buffer occupancy (max / mean / capacity)"]
+        for name in self.buffers:
+            occupancy = [sample[2][name][0] for sample in self.samples]
+            capacity = self.samples[-1][2][name][1] if self.samples else 0
+            if occupancy:
+                lines.append(f"{name}: {max(occupancy)} / {sum(occupancy) / len(occupancy):.1f} / "
+                             f"{capacity if capacity else 'unbounded'}")
+        lines += ["", f"## Top {self.top} allocators"]
+        for stat in snapshot.statistics("lineno")[:self.top]:
+            lines.append(str(stat))
+        lines += ["", "## Samples", "time_s,rss_mb," + ",".join(self.buffers)]
+        for elapsed, rss, occupancy in self.samples:
+            lines.append(f"{elapsed:.1f},{rss / MB:.1f}," + ",".join(str(occupancy[name][0]) for name in self.buffers))
+
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        lg.info(f"Memory report saved as {path}")
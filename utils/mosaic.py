@@ -0,0 +1,72 @@
+"""
+Helpers describing the layout of the recorded mosaic videos.
+Every camera produces one RGB and one NIR frame stacked horizontally, and cameras are stacked vertically:
+
+    +-------+-------+
+    | RGB 0 | NIR 0 |
+    +-------+-------+
+    | RGB 1 | NIR 1 |
+    +-------+-------+
+    |  ...  |  ...  |
+"""
+
+MODALITIES = ["rgb", "nir"]
+
+
+def get_mosaic_size(cam_number, input_width, input_height):
+    """
+    Return the size of the mosaic written for a given number of cameras.
+    :param cam_number:          Number of cameras in the mosaic
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :return: (width, height) tuple
+    """
+    # Double the width for the output as each NIR + RGB is stacked horizontally
+    mosaic_width = input_width * len(MODALITIES)
+    # Multiply the height by the number of cameras as each RGB + NIR is stacked vertically
+    mosaic_height = input_height * cam_number
+
+    return mosaic_width, mosaic_height
+
+
+def get_cam_number(mosaic_height, input_height):
+    """
+    Deduce the number of cameras from the height of a mosaic.
+    :param mosaic_height:       Height of the mosaic in pxl
+    :param input_height:        Height of every single video stream
+    :return: Number of cameras as int
+    """
+    if mosaic_height % input_height:
+        raise Warning(f"Mosaic height {mosaic_height} is not a multiple of the input height {input_height}")
+
+    return mosaic_height // input_height
+
+
+def check_mosaic_width(mosaic_width, input_width) -> None:
+    """
+    Check that the width of a mosaic matches the width of the single video streams.
+    :param mosaic_width:        Width of the mosaic in pxl
+    :param input_width:         Width of every single video stream
+    """
+    expected_width = get_mosaic_size(1, input_width, 0)[0]
+    if mosaic_width != expected_width:
+        raise Warning(f"Mosaic width {mosaic_width} does not match the input width {input_width}, "
+                      f"{expected_width} expected")
+
+
+def get_tiles(cam_number, input_width, input_height):
+    """
+    Return the position of every tile of the mosaic.
+    :param cam_number:          Number of cameras in the mosaic
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :return: List of (cam_idx, modality, (y0, y1, x0, x1)) tuples
+    """
+    tiles = []
+    for cam_idx in range(cam_number):
+        for mod_idx, modality in enumerate(MODALITIES):
+            box = (cam_idx * input_height, (cam_idx + 1) * input_height,
+                   mod_idx * input_width, (mod_idx + 1) * input_width)
+            tiles.append((cam_idx, modality, box))
+
+    return tiles
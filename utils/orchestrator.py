@@ -0,0 +1,256 @@
+"""
+Asyncio orchestration of recording sessions.
+
+Trigger sources (timer, emails) run concurrently and queue participants. Sessions are consumed one at a time, and the
+blocking steps of a session (camera warm-up, media cues, writer start) run concurrently in executor threads with
+per-step timeouts. Written for python >= 3.6, hence get_event_loop and ensure_future.
+"""
+import time
+import asyncio
+import functools
+import logging as lg
+
+
+async def wait_step(name, future, timeout=None, start=None):
+    """
+    Wait for a step running in an executor thread. Threads cannot be interrupted: on timeout or cancellation the
+    future is left running, so that the caller can still wait for its result and release what the step started.
+    :param name:        Name of the step used in logs
+    :param future:      Future of the step, as returned by run_in_executor
+    :param timeout:     Maximum duration in seconds, None to wait forever
+    :param start:       Monotonic time at which the step started, the timeout counts from it. Defaults to now
+    :return: Result of the step
+    """
+    start = start if start is not None else time.monotonic()
+    remaining = max(0., start + timeout - time.monotonic()) if timeout is not None else None
+    try:
+        result = await asyncio.wait_for(asyncio.shield(future), remaining)
+    except asyncio.TimeoutError:
+        raise Exception(f"Step '{name}' timed out after {timeout}s")
+    lg.debug(f"Step '{name}' done in {time.monotonic() - start:.2f}s")
+
+    return result
+
+
+async def run_step(name, func, *args, timeout=None):
+    """
+    Run a blocking step in the default executor.
+    :param name:        Name of the step used in logs
+    :param func:        Blocking callable
+    :param args:        Arguments of func
+    :param timeout:     Maximum duration in seconds, None to wait forever
+    :return: Result of func
+    """
+    loop = asyncio.get_event_loop()
+
+    return await wait_step(name, loop.run_in_executor(None, functools.partial(func, *args)), timeout)
+
+
+async def play_media(path, wait, timeout=None, poll=0.05):
+    """
+    Play a media with VLC without blocking the event loop.
+    :param path:        Path to the media
+    :param wait:        Whether to wait for the media to end
+    :param timeout:     Maximum duration of the media in seconds when waiting, None to wait forever
+    :param poll:        Interval in seconds between two checks of the player state
+    :return: vlc.MediaPlayer
+    """
+    from utils.utils import play_vlc
+
+    player = play_vlc(path=path, wait=False)
+    if not wait:
+        return player
+
+    async def wait_end():
+        # is_playing is False until VLC actually starts the media
+        while not player.is_playing():
+            await asyncio.sleep(poll)
+        while player.is_playing():
+            await asyncio.sleep(poll)
+
+    try:
+        await asyncio.wait_for(wait_end(), timeout)
+    except asyncio.TimeoutError:
+        player.stop()
+        raise Exception(f"Media {path} did not end within {timeout}s")
+    except asyncio.CancelledError:
+        player.stop()
+        raise
+
+    return player
+
+
+async def wait_first_frame(writer, timeout=None, poll=0.005):
+    """
+    Wait for the writer to write its first frame.
+    :param writer:      Started video Writer
+    :param timeout:     Maximum waiting time in seconds
+    :param poll:        Interval in seconds between two checks
+    """
+    async def wait():
+        while not writer.frame_count:
+            await asyncio.sleep(poll)
+
+    try:
+        await asyncio.wait_for(wait(), timeout)
+    except asyncio.TimeoutError:
+        raise Exception(f"No frame recorded within {timeout}s")
+
+
+async def timer_source(queue, period):
+    """
+    Trigger a session without participant every period seconds after the end of the previous one.
+    :param queue:       asyncio.Queue of (trigger time, participant, callback) tuples
+    :param period:      Seconds between the end of a session and the next trigger
+    """
+    while True:
+        await asyncio.sleep(period)
+        await queue.put((time.monotonic(), None, None))
+        await queue.join()
+
+
+async def email_source(queue, imap, period, fname, stored_data=None, timeout=None):
+    """
+    Trigger a session for every new participant registration received by email.
+    The whole inbox is backfilled first, so registrations received while the program was stopped or while a session
+    was recording are all queued in arrival order. Registrations already in fname are skipped, and a registration is
+    only appended to fname once its session succeeded: participants still queued when the program stops are queued
+    again on the next start, and participants whose session failed are queued again on the next check.
+    A check exceeding the timeout is not started again: the next iteration keeps waiting for it, so that its
+    registrations are not lost and the IMAP connection is never used by two threads.
+    :param queue:           asyncio.Queue of (trigger time, participant, callback) tuples
+    :param imap:            Logged in IMAP connection
+    :param period:          Seconds between two email checks
+    :param fname:           Json file where recorded registrations are saved
+    :param stored_data:     Registrations already recorded, read from fname if None
+    :param timeout:         Maximum duration of an email check
+    """
+    from utils.automatic_data_collection import backfill_registrations, load_registrations, save_registrations
+
+    loop = asyncio.get_event_loop()
+    data = stored_data if stored_data is not None else load_registrations(fname)
+    # Hashes of the recorded registrations and of the ones queued by this run
+    hashes = {em["hash"] for em in data}
+    failed = []
+
+    def session_ended(registration, success):
+        if success:
+            data.append(registration)
+            save_registrations(fname, data)
+        else:
+            lg.warning(f"Session of participant {registration['uuid']} failed, it will be queued again")
+            failed.append(registration)
+
+    cursor = None
+    check = None
+    while True:
+        if check is None:
+            # The check gets its own copy of the hashes, they are only updated here once it succeeded
+            check = loop.run_in_executor(None, functools.partial(backfill_registrations, imap, set(hashes), cursor))
+        try:
+            new, cursor = await wait_step("mail backfill", check, timeout)
+            check = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            lg.error(f"Email check failed: {e}")
+            if check.done():
+                check = None
+            new = []
+        hashes.update(em["hash"] for em in new)
+        # Failed sessions are retried before the registrations received since
+        retry, failed[:] = failed[:], []
+        for em in retry + new:
+            await queue.put((time.monotonic(), em, functools.partial(session_ended, em)))
+        await asyncio.sleep(period)
+
+
+class SessionOrchestrator:
+    """
+    Class running trigger sources concurrently and recording one session per trigger.
+    """
+
+    def __init__(self, session, sources, restart_delay=5.):
+        """
+        :param session:         Coroutine function taking (participant, trigger_time) and recording one session
+        :param sources:         List of coroutine functions taking the trigger queue, and putting (trigger time,
+                                participant, callback) tuples in it. callback is None or is called with whether the
+                                session succeeded
+        :param restart_delay:   Seconds before restarting a failed source
+        """
+        self.session = session
+        self.sources = sources
+        self.restart_delay = restart_delay
+
+    async def supervise(self, source, queue):
+        """
+        Run a trigger source and restart it when it fails, so that no trigger source dies silently.
+        :param source:      Coroutine function taking the trigger queue
+        :param queue:       asyncio.Queue of (trigger time, participant) tuples
+        """
+        while True:
+            try:
+                await source(queue)
+                lg.error("Trigger source ended")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                lg.exception(f"Trigger source failed: {e}")
+            lg.warning(f"Restarting trigger source in {self.restart_delay}s")
+            await asyncio.sleep(self.restart_delay)
+
+    @staticmethod
+    def notify(callback, success) -> None:
+        """
+        Tell the source of a trigger how its session ended.
+        :param callback:    Callable taking whether the session succeeded
+        :param success:     Whether the session succeeded
+        """
+        try:
+            callback(success)
+        except Exception as e:
+            lg.exception(f"Session end callback failed: {e}")
+
+    async def run(self):
+        """
+        Consume triggers until cancelled. A failed session is logged and the next trigger is processed.
+        Failed sources are logged and restarted. Sources are cancelled when leaving.
+        """
+        queue = asyncio.Queue()
+        tasks = [asyncio.ensure_future(self.supervise(source, queue)) for source in self.sources]
+        try:
+            while True:
+                trigger_time, participant, callback = await queue.get()
+                success = False
+                try:
+                    await self.session(participant, trigger_time)
+                    success = True
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    lg.exception(f"Session failed: {e}")
+                finally:
+                    queue.task_done()
+                    if callback is not None:
+                        self.notify(callback, success)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run_forever(self) -> None:
+        """
+        Run the orchestrator in the event loop of the main thread.
+        On KeyboardInterrupt, the running session is cancelled and shut down cleanly before re-raising.
+        """
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(self.run())
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            raise
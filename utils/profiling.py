@@ -0,0 +1,67 @@
+"""
+Startup profiling: time imports and initialization steps as a tree.
+Sections are only timed once the profiler is enabled, e.g with `main.py --profile-startup`.
+"""
+import time
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    """
+    Class building a tree of timed sections. Nested sections become children of the enclosing one.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # Origin is the first import of this module, i.e the very beginning of main.py
+        self.origin = time.perf_counter()
+        # Nodes are [name, duration in seconds, children]
+        self.root = ["startup", 0., []]
+        self.stack = [self.root]
+        self.first_section = None
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    @contextmanager
+    def section(self, name):
+        """
+        Time the enclosed block as a child of the current section.
+        :param name:    Name displayed in the tree
+        """
+        if not self.enabled:
+            yield
+            return
+        node = [name, 0., []]
+        if self.first_section is None:
+            self.first_section = time.perf_counter()
+            self.root[2].append(["main.py imports and arguments", self.first_section - self.origin, []])
+        self.stack[-1][2].append(node)
+        self.stack.append(node)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            node[1] = time.perf_counter() - start
+            self.stack.pop()
+
+    def report(self) -> None:
+        """
+        Print the timing tree and stop profiling.
+        The root duration is the time spent in profiled sections, waiting for a trigger is not included.
+        """
+        if not self.enabled:
+            return
+        self.root[1] = sum(child[1] for child in self.root[2])
+
+        def print_node(node, depth):
+            name, duration, children = node
+            print(f"{duration * 1000:10.1f} ms  {'    ' * depth}{name}")
+            for child in children:
+                print_node(child, depth + 1)
+
+        print_node(self.root, 0)
+        self.enabled = False
+
+
+profiler = StartupProfiler()
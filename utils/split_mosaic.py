@@ -0,0 +1,202 @@
+"""
+Standalone script that splits recorded mosaics into one clip per camera, per modality and per protocol step.
+
+Every mosaic is decoded only once: all tiles of every active step are written while reading frames sequentially,
+and frames between two steps are skipped by seeking. When a timeline index has been saved next to the mosaic, steps
+are located with it, else the audio script is assumed to start with the recording.
+Videos are spread across a process pool. Finished clips are written under a temporary name and renamed once complete,
+so an interrupted run can simply be restarted and resumes where it stopped. A video is only skipped as a whole when it
+has been split with the same timing table, steps added later are written on the next run.
+
+The timing table is a csv file with a `step,start,end` header, times being expressed in seconds of the audio script:
+
+    step,start,end
+    gaze_1,12.0,16.5
+    speech_1,16.5,21.0
+"""
+import os
+import argparse
+from hashlib import sha1
+import logging as lg
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from utils.mosaic import get_cam_number, check_mosaic_width, get_tiles
+from utils.timeline import read_timing_table, TimelineIndex
+
+TMP_SUFFIX = ".part.mp4"
+DONE_SUFFIX = ".done"
+
+
+def get_clip_name(output_folder, video_path, step, cam_idx, modality) -> str:
+    """
+    Name of the clip of a single tile for a given step.
+    :param output_folder:       Root folder of the clips
+    :param video_path:          Path to the source mosaic
+    :param step:                Name of the protocol step
+    :param cam_idx:             Index of the camera in the mosaic
+    :param modality:            rgb or nir
+    :return: Clip path as str
+    """
+    return str(Path(output_folder) / Path(video_path).stem / f"{step}_cam{cam_idx}_{modality}.mp4")
+
+
+def get_step_frames(steps, fps, index=None):
+    """
+    Convert the steps of the timing table into frame intervals.
+    :param steps:       List of (step, start, end) tuples, times in seconds
+    :param fps:         FPS of the mosaic
+    :param index:       TimelineIndex of the mosaic if available
+    :return: List of (step, first_frame, last_frame) tuples sorted by first frame, last frame excluded
+    """
+    if index is not None:
+        return sorted(index.resolve_steps(steps), key=lambda step: step[1])
+
+    return [(step, int(round(start * fps)), int(round(end * fps))) for step, start, end in steps]
+
+
+def get_steps_hash(steps, input_width, input_height) -> str:
+    """
+    Hash of the timing table and tile size a video is split with, stored in its done marker.
+    :param steps:               List of (step, start, end) tuples, times in seconds
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :return: Hexadecimal digest
+    """
+    return sha1(repr((sorted(steps), input_width, input_height)).encode()).hexdigest()
+
+
+def split_video(video_path, steps, output_folder, input_width, input_height):
+    """
+    Decode one mosaic once and write every tile of every step in its own clip.
+    This function is called in a separated process.
+    :param video_path:          Path to the mosaic video
+    :param steps:               List of (step, start, end) tuples, times in seconds
+    :param output_folder:       Root folder of the clips
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :return: Number of clips written
+    """
+    # Processes already run in parallel, avoid oversubscribing cores with OpenCV threads
+    cv2.setNumThreads(1)
+
+    done_marker = Path(output_folder) / (Path(video_path).stem + DONE_SUFFIX)
+    steps_hash = get_steps_hash(steps, input_width, input_height)
+    if done_marker.exists() and done_marker.read_text() == steps_hash:
+        lg.info(f"{video_path} already split with this timing table, skipping")
+        return 0
+
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise Exception(f"Unable to open {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    codec = cv2.VideoWriter_fourcc(*'mp4v')
+    mosaic_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    mosaic_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    # A wrong input size would slice tiles at wrong offsets, and VideoWriter silently drops frames of the wrong size
+    try:
+        check_mosaic_width(mosaic_width, input_width)
+        tiles = get_tiles(get_cam_number(mosaic_height, input_height), input_width, input_height)
+    except Warning:
+        capture.release()
+        raise
+
+    # Only keep steps with at least one missing clip
+    todo = []
+    for step, first, last in get_step_frames(steps, fps, TimelineIndex.load(video_path)):
+        # Steps running past the end of the recording are cut at its last frame, as TimelineIndex does
+        if last > frame_count:
+            lg.warning(f"{video_path}: step {step} ends after the recording, cut at frame {frame_count}")
+            last = frame_count
+        if last <= first:
+            lg.warning(f"{video_path}: step {step} is out of the recording, skipping")
+            continue
+        clips = [get_clip_name(output_folder, video_path, step, cam_idx, modality) for cam_idx, modality, _ in tiles]
+        if not all(os.path.exists(clip) for clip in clips):
+            todo.append((step, first, last, clips))
+
+    os.makedirs(Path(output_folder) / Path(video_path).stem, exist_ok=True)
+    written = 0
+    finished = 0
+    writers = {}
+    frame_idx = 0
+    last_frame = max((last for _, _, last, _ in todo), default=0)
+    while frame_idx < last_frame:
+        # Seek to the next step instead of decoding frames outside of every step
+        if not writers:
+            next_first = min((first for _, first, _, _ in todo if first >= frame_idx), default=frame_idx)
+            if next_first > frame_idx:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, next_first)
+                frame_idx = next_first
+        ret, frame = capture.read()
+        if not ret:
+            lg.warning(f"{video_path} ended at frame {frame_idx} before the end of the timing table")
+            break
+        for step, first, last, clips in todo:
+            if frame_idx == first:
+                writers[step] = [cv2.VideoWriter(clip + TMP_SUFFIX, codec, fps, (input_width, input_height))
+                                 for clip in clips]
+            if step in writers:
+                for writer, (_, _, (y0, y1, x0, x1)) in zip(writers[step], tiles):
+                    writer.write(frame[y0:y1, x0:x1])
+            if frame_idx == last - 1 and step in writers:
+                for writer, clip in zip(writers.pop(step), clips):
+                    writer.release()
+                    os.replace(clip + TMP_SUFFIX, clip)
+                    written += 1
+                finished += 1
+        frame_idx += 1
+
+    # Truncated video: keep the partial clips as temporary files so they are rewritten on the next run
+    for step_writers in writers.values():
+        for writer in step_writers:
+            writer.release()
+    capture.release()
+
+    if finished == len(todo):
+        done_marker.write_text(steps_hash)
+
+    return written
+
+
+def split_folder(input_folder, timing_table, output_folder, input_width, input_height, workers=None) -> None:
+    """
+    Split every mosaic of a folder using a process pool.
+    :param input_folder:        Folder containing the mosaics as mp4
+    :param timing_table:        Path to the csv timing table
+    :param output_folder:       Root folder of the clips
+    :param input_width:         Width of every single video stream
+    :param input_height:        Height of every single video stream
+    :param workers:             Number of processes, defaults to the number of cores
+    """
+    steps = read_timing_table(timing_table)
+    videos = sorted(str(path) for path in Path(input_folder).glob("*.mp4"))
+    lg.info(f"Splitting {len(videos)} videos in {len(steps)} steps")
+    os.makedirs(output_folder, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(split_video, video, steps, output_folder, input_width, input_height): video
+                   for video in videos}
+        for future in as_completed(futures):
+            try:
+                lg.info(f"{futures[future]}: {future.result()} clips written")
+            except Exception as e:
+                lg.error(f"{futures[future]}: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split recorded mosaics into per camera and per modality clips.")
+    parser.add_argument("input_folder", help="Folder containing the recorded mosaics.")
+    parser.add_argument("--timing-table", required=True, help="Csv file with step,start,end columns in seconds.")
+    parser.add_argument("--output-folder", default="./clips/", help="Folder where to save clips.")
+    parser.add_argument("--input-width", "-iw", type=int, default=1280, help="Width of every single video stream.")
+    parser.add_argument("--input-height", "-ih", type=int, default=720, help="Height of every single video stream.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes. Default to the core count.")
+    parser.add_argument("--verbose", "-v", help="Run the code in verbose mode.", action='store_true')
+    args = parser.parse_args()
+
+    lg.basicConfig(level=lg.DEBUG if args.verbose else lg.INFO)
+
+    split_folder(args.input_folder, args.timing_table, args.output_folder,
+                 args.input_width, args.input_height, args.workers)
@@ -1,6 +1,7 @@
 import time
-from threading import Thread
-from queue import Queue
+import logging as lg
+from threading import Thread, Lock
+from queue import Queue, Empty
 import pyrealsense2 as rs2
 import cv2
 import numpy as np
@@ -9,6 +10,9 @@ ACCEPTED_WIDTHS = [640, 1280, 1920]
 ACCEPTED_HEIGHTS = [480, 720, 1080]
 ACCEPTED_DIMS = [str(ACCEPTED_WIDTHS[i]) + "x" + str(ACCEPTED_HEIGHTS[i]) for i in range(len(ACCEPTED_WIDTHS))]
 ACCEPTED_FPS = [30, 60]
+STALL_FILLS = ["repeat", "blank"]
+# Depth sensors do not stream at 1920x1080
+ACCEPTED_DEPTH_WIDTHS = [640, 1280]
 
 
 class ReaderRealSense:
@@ -16,11 +20,18 @@ class ReaderRealSense:
     Class that continuously gets frames from a RealSense camera with a dedicated thread.
     Initialize the pyrealsense pipeline and camera configuration
     Initialize the queue used to store frames read from.
-    Return one RGB and one NIR frame at the same time.
+    Return one RGB and one NIR frame at the same time, along with the raw uint16 depth frame if depth is enabled.
+    When the camera stalls, read returns substitute frames until the pipeline is restarted, see CameraWatchdog.
     """
 
-    def __init__(self, serial_number, width=640, height=480, fps=30, disable_projector=True, nir_id=1):
+    def __init__(self, serial_number, width=640, height=480, fps=30, disable_projector=True, nir_id=1,
+                 stall_fill="repeat", frame_timeout_ms=1000, queue_size=64, depth=False):
         self.serial_number = serial_number
+        # Substitute frame used while the camera stalls: repeat the last frame or insert a marked blank frame
+        if stall_fill not in STALL_FILLS:
+            raise Warning(f"Invalid stall fill, please use one of the following: {STALL_FILLS}")
+        self.stall_fill = stall_fill
+        self.frame_timeout_ms = frame_timeout_ms
 
         # Set camera parameters
         # see width setter for conditions
@@ -30,30 +41,51 @@ class ReaderRealSense:
         # see fps setter for conditions
         self.fps = fps
         self.nir_id = nir_id
-
-        # Initialize RealSense pipeline, context and config
-        self.pipeline = rs2.pipeline()
-        self.ctx = rs2.context()
-        self.config = rs2.config()
-        self.setup_config()
+        self.depth = depth
+        if self.depth and self.width not in ACCEPTED_DEPTH_WIDTHS:
+            raise Warning(f"Depth is not available at width {self.width}, please use one of: {ACCEPTED_DEPTH_WIDTHS}")
+        # Depth frame matching the last frame returned by read, None without depth or for substitute frames
+        self.depth_frame = None
+        # Monotonic time at which the last frame returned by read has been captured, None for substitute frames
+        self.frame_time = None
 
         # Boolean for stopping thread
         self.stopped = False
 
-        # Select desired RealSense camera
-        self.profile = self.pipeline.start(self.config)
-        self.device = self.profile.get_device()
-
-        # Disable pattern projector for NIR
+        # Initialize RealSense pipeline, context and config then select desired RealSense camera
+        self.ctx = rs2.context()
         self.disable_projector = disable_projector
-        if self.disable_projector:
-            self.disable_pattern_projector()
+        # Serializes pipeline restarts of the watchdog with the final stop
+        self.pipeline_lock = Lock()
+        self.start_pipeline()
 
         # Initialize first frames
         self.frames = self.pipeline.wait_for_frames()
 
+        # Stall detection and recovery, last_frame_time is a heartbeat checked by the watchdog
+        self.last_frame_time = time.monotonic()
+        self.reconnecting = False
+        self.recovery_start = None
+        self.last_frame = None
+        # Frames missing while the camera was stalled, and their number at the last real frame
+        self.lost_frames = 0
+        self.lost_frames_mark = 0
+        # Time and number of lost frames at the last real frame returned by read, lost frames are counted from time
+        self.last_read_time = None
+        self.lost_frames_read = 0
+        # Capture time of the first real frame read after substitute frames, the other cameras kept queuing frames
+        # meanwhile and must be realigned on it, see utils.utils.realign_readers
+        self.substituting = False
+        self.resume_time = None
+
+        # Counters of frames read and frames lost by the camera, detected with gaps in frame numbers
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self.last_frame_number = self.frames.get_frame_number()
+
         # initialize the queue used to store frames read from the video file
-        self.queue = Queue(maxsize=64)
+        # its size is set by the memory budget, see utils.memory.plan_buffers
+        self.queue = Queue(maxsize=queue_size)
 
         # Init thread attribute
         self.thread = None
@@ -91,6 +123,46 @@ class ReaderRealSense:
         else:
             raise Warning(f"Invalid FPS for recording, please use one of the following FPS: {ACCEPTED_FPS}")
 
+    def start_pipeline(self) -> None:
+        """
+        Create and start a new RealSense pipeline for this camera.
+        """
+        self.pipeline = rs2.pipeline()
+        self.config = rs2.config()
+        self.setup_config()
+        self.profile = self.pipeline.start(self.config)
+        self.device = self.profile.get_device()
+
+        # Disable pattern projector for NIR
+        if self.disable_projector:
+            self.disable_pattern_projector()
+
+    def restart(self) -> None:
+        """
+        Restart the pipeline of a stalled camera. Blocks until the camera is back or the reader is stopped,
+        so this method is called in a separated thread by the watchdog.
+        """
+        self.reconnecting = True
+        self.recovery_start = time.monotonic()
+        self.stop_pipeline()
+        while not self.stopped:
+            try:
+                with self.pipeline_lock:
+                    # The reader may have been stopped, and its camera released, while waiting for the lock
+                    if not self.stopped:
+                        self.start_pipeline()
+                break
+            except RuntimeError as e:
+                lg.warning(f"Camera {self.serial_number} reconnection failed: {e}")
+                time.sleep(1)
+        # Frame numbers restart with the new pipeline
+        self.last_frame_number = None
+        self.last_frame_time = time.monotonic()
+        self.reconnecting = False
+        # Restart the reading thread if it died with the camera
+        if not self.stopped and (self.thread is None or not self.thread.is_alive()):
+            self.start()
+
     def setup_config(self) -> None:
         """
         Setup RealSense camera configuration, select camera by serial number, set width, fps, color.
@@ -99,6 +171,8 @@ class ReaderRealSense:
         self.config.enable_device(self.serial_number)
         self.config.enable_stream(rs2.stream.color, self.width, self.height, rs2.format.rgb8, self.fps)
         self.config.enable_stream(rs2.stream.infrared, self.nir_id, self.width, self.height, rs2.format.y8, self.fps)
+        if self.depth:
+            self.config.enable_stream(rs2.stream.depth, self.width, self.height, rs2.format.z16, self.fps)
 
     def start(self):
         """
@@ -110,11 +184,25 @@ class ReaderRealSense:
         self.thread.start()
         return self
 
+    def stop_pipeline(self) -> None:
+        """
+        Stop the RealSense pipeline, releasing the camera.
+        """
+        try:
+            self.pipeline.stop()
+        except RuntimeError:
+            # Already stopped
+            pass
+
     def stop(self):
         """
-        Set to TRUE the stopped attribute to stop de main loop
+        Set to TRUE the stopped attribute to stop de main loop, then release the camera once the thread has exited
         """
         self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+        with self.pipeline_lock:
+            self.stop_pipeline()
 
     def get(self):
         """
@@ -122,9 +210,27 @@ class ReaderRealSense:
         """
         while not self.stopped:
             time.sleep(0.0001)
-            if not self.queue.full():
+            if self.reconnecting:
+                time.sleep(0.01)
+            elif self.queue.full():
+                # The consumer is late but the camera is alive
+                self.last_frame_time = time.monotonic()
+            else:
                 # Read last frames
-                self.frames = self.pipeline.wait_for_frames()
+                try:
+                    self.frames = self.pipeline.wait_for_frames(self.frame_timeout_ms)
+                except RuntimeError as e:
+                    # The watchdog restarts the pipeline when the camera stalls for too long
+                    lg.debug(f"Camera {self.serial_number}: {e}")
+                    continue
+                self.last_frame_time = time.monotonic()
+                self.count_frames()
+                if self.recovery_start is not None:
+                    lg.warning(f"Camera {self.serial_number} recovered in "
+                               f"{self.last_frame_time - self.recovery_start:.2f}s, "
+                               f"{self.lost_frames - self.lost_frames_mark} frames lost")
+                    self.recovery_start = None
+                self.lost_frames_mark = self.lost_frames
 
                 # get color frames
                 color_frame = self.get_color_frame()
@@ -134,15 +240,84 @@ class ReaderRealSense:
 
                 color_nir_frame = np.hstack((color_frame, nir_frame))
 
-                # add the frame to the queue
-                self.queue.put(color_nir_frame)
+                # add the frame to the queue along with its depth and capture time, so that they stay aligned
+                self.queue.put((color_nir_frame, self.get_depth_frame() if self.depth else None,
+                                self.last_frame_time))
+
+    def count_frames(self) -> None:
+        """
+        Update frame counters with the number of the last frames read
+        """
+        frame_number = self.frames.get_frame_number()
+        if self.last_frame_number is not None and frame_number > self.last_frame_number + 1:
+            self.dropped_frames += frame_number - self.last_frame_number - 1
+        self.last_frame_number = frame_number
+        self.frame_count += 1
 
     def read(self):
         """
         Return next frame in the queue. Wait for next frame if not available.
+        If no frame arrives within a few frame periods, or within one frame period while the camera is reconnecting,
+        return a substitute frame so that the mosaic keeps going at the camera frame rate.
+        :return: OpenCV image
+        """
+        start = time.monotonic()
+        if self.last_read_time is None:
+            self.last_read_time = start
+        try:
+            frame, self.depth_frame, self.frame_time = self.queue.get(timeout=(1 if self.reconnecting else 5) / self.fps)
+        except Empty:
+            self.count_lost_frames()
+            self.depth_frame = None
+            self.frame_time = None
+            self.substituting = True
+            return self.substitute_frame()
+        if self.substituting:
+            self.substituting = False
+            self.resume_time = self.frame_time
+        self.last_frame = frame
+        self.last_read_time = time.monotonic()
+        self.lost_frames_read = self.lost_frames
+
+        return frame
+
+    def drop_frames_before(self, capture_time) -> int:
+        """
+        Drop the queued frames captured before a time. Only called from the thread calling read.
+        Dropped frames are counted in dropped_frames.
+        :param capture_time:    Monotonic time
+        :return: Number of frames dropped
+        """
+        dropped = 0
+        while True:
+            with self.queue.mutex:
+                if not self.queue.queue or self.queue.queue[0][2] >= capture_time:
+                    break
+            self.queue.get_nowait()
+            dropped += 1
+        self.dropped_frames += dropped
+
+        return dropped
+
+    def count_lost_frames(self) -> None:
+        """
+        Update the number of lost frames with the frame periods elapsed since the last real frame returned by read,
+        so that it does not depend on how often substitute frames are read
+        """
+        self.lost_frames = self.lost_frames_read + int((time.monotonic() - self.last_read_time) * self.fps)
+
+    def substitute_frame(self):
+        """
+        Frame used in place of a missing one: the last frame read, or a blank frame marked with the camera serial.
         :return: OpenCV image
         """
-        return self.queue.get(block=True)
+        if self.stall_fill == "repeat" and self.last_frame is not None:
+            return self.last_frame
+        frame = np.zeros((self.height, self.width * 2, 3), dtype=np.uint8)
+        cv2.putText(frame, f"NO SIGNAL {self.serial_number}", (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.5,
+                    (0, 0, 255), 3)
+
+        return frame
 
     def disable_pattern_projector(self):
         """
@@ -166,6 +341,14 @@ class ReaderRealSense:
         """
         return cv2.cvtColor(np.asanyarray(self.frames.get_infrared_frame(nir_id).get_data()), cv2.COLOR_GRAY2RGB)
 
+    def get_depth_frame(self):
+        """
+        Get RealSense depth frame, kept as raw uint16 values
+        :return: numpy array uint16 depth frame
+        """
+        # Copy as the buffer is reused by librealsense once the frame is released
+        return np.array(self.frames.get_depth_frame().get_data(), dtype=np.uint16)
+
     def clear(self) -> None:
         """
         Clear all elements of the queue. Useful for synchronizing queue initialization on different threads.
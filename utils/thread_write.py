@@ -1,8 +1,20 @@
 import time
 import cv2
-from threading import Thread
+from threading import Thread, Lock
+from queue import Queue, Empty, Full
 import logging as lg
 import os
+import numpy as np
+from utils.timeline import get_timeline_name
+
+
+def get_depth_folder(video_file_name) -> str:
+    """
+    Name of the folder where the depth of a video is saved.
+    :param video_file_name:     Path to the video
+    :return: Path to the folder as str
+    """
+    return os.path.splitext(video_file_name)[0] + "_depth"
 
 
 class Writer:
@@ -11,7 +23,7 @@ class Writer:
     Initialize the video writer along with the boolean used to indicate if the thread should be stopped or not.
     Initialize the thread and frame used to store frames read from.
     """
-    def __init__(self, name, fps, width, height):
+    def __init__(self, name, fps, width, height, timeline=None, steps=None, depth=False):
         # Set up codec and output video settings
         # See video_file_name setter for conditions
         self.video_file_name = name
@@ -20,7 +32,18 @@ class Writer:
         self.height = height
         self.codec = cv2.VideoWriter_fourcc(*'mp4v')
         self.output = None
+        # Last (mosaic, time, depth frames) set and not written yet, swapped under the lock to keep them together
         self.frame = None
+        self.lock = Lock()
+        # Frames written and frames overwritten before being written
+        self.frame_count = 0
+        self.dropped_frames = 0
+        # Optional session timeline stamping every written frame, saved next to the video with the resolved steps
+        self.timeline = timeline
+        self.steps = steps
+        # Depth frames are handed to a DepthWriter along with the index of the mosaic frame they belong to
+        self.depth = depth
+        self.depth_writer = None
         self.stopped = False
         self.started = False
         self.thread = None
@@ -39,6 +62,10 @@ class Writer:
                                           (self.width, self.height)
                                           )
             self.started = True
+            if self.timeline is not None:
+                self.timeline.mark("record_start")
+            if self.depth:
+                self.depth_writer = DepthWriter(get_depth_folder(self.video_file_name)).start()
             self.thread = Thread(target=self.save, args=())
             self.thread.start()
         return self
@@ -63,16 +90,31 @@ class Writer:
         """
         Set the stopped attribute to TRUE & release the writer object
         """
+        already_stopped = self.stopped
         self.stopped = True
+        # Wait for the last frame to be written before releasing the output
+        if self.thread is not None:
+            self.thread.join()
         if self.output is not None:
             lg.info(f"Video saved as {self.video_file_name}")
             self.output.release()
+            if self.depth_writer is not None:
+                self.depth_writer.stop()
+            if self.timeline is not None and not already_stopped:
+                self.timeline.save(get_timeline_name(self.video_file_name), self.steps)
 
-    def write_frame(self, frame):
+    def write_frame(self, frame, depth_frames=None, frame_time=None):
         """
         Set the frame to write to the last one read
+        :param frame:           Mosaic to write
+        :param depth_frames:    Optional dict of camera serial to uint16 depth frame captured with the mosaic
+        :param frame_time:      Monotonic time at which the mosaic has been captured, default to now
         """
-        self.frame = frame
+        frame_time = frame_time if frame_time is not None else time.monotonic()
+        with self.lock:
+            if self.frame is not None:
+                self.dropped_frames += 1
+            self.frame = (frame, frame_time, depth_frames)
 
     def save(self):
         """
@@ -80,6 +122,94 @@ class Writer:
         """
         while not self.stopped:
             time.sleep(0.00001)
-            if self.frame is not None:
-                self.output.write(self.frame)
-                self.frame = None
+            with self.lock:
+                pending, self.frame = self.frame, None
+            if pending is not None:
+                frame, frame_time, depth_frames = pending
+                self.output.write(frame)
+                if self.depth_writer is not None and depth_frames:
+                    self.depth_writer.put(self.frame_count, depth_frames)
+                self.frame_count += 1
+                if self.timeline is not None:
+                    self.timeline.add_frame(frame_time)
+
+
+class DepthWriter:
+    """
+    Class that continuously writes uint16 depth frames with a dedicated thread.
+    Frames are stored losslessly without any conversion, in zlib compressed npz chunks, one file per camera and chunk:
+    <serial>_<first frame index>.npz containing `frames` (n, height, width) uint16 and `index` (n,) int64, the index
+    of the mosaic frame every depth frame belongs to.
+    Frames are dropped rather than slowing down the mosaic writer when compression falls behind.
+    """
+    def __init__(self, folder, chunk_size=32, queue_size=32):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.queue = Queue(maxsize=queue_size)
+        # Frames and mosaic indexes waiting to be compressed, per camera serial
+        self.chunks = {}
+        self.dropped_frames = 0
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the thread and begin writing
+        :return: DepthWriter class
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        self.thread = Thread(target=self.save, args=())
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Set the stopped attribute to TRUE, write remaining frames and wait for the thread to end
+        """
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+        for serial in list(self.chunks):
+            self.flush(serial)
+        if self.dropped_frames:
+            lg.warning(f"{self.dropped_frames} depth frames dropped")
+        lg.info(f"Depth saved in {self.folder}")
+
+    def put(self, frame_idx, depth_frames) -> None:
+        """
+        Queue the depth frames of a mosaic frame without blocking.
+        :param frame_idx:       Index of the mosaic frame in the video
+        :param depth_frames:    Dict of camera serial to uint16 depth frame
+        """
+        try:
+            self.queue.put_nowait((frame_idx, depth_frames))
+        except Full:
+            self.dropped_frames += 1
+
+    def save(self):
+        """
+        Loop until the thread stop and the queue is empty to compress depth frames
+        """
+        while not self.stopped or not self.queue.empty():
+            try:
+                frame_idx, depth_frames = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            for serial, depth_frame in depth_frames.items():
+                if depth_frame is None:
+                    continue
+                frames, index = self.chunks.setdefault(serial, ([], []))
+                frames.append(depth_frame)
+                index.append(frame_idx)
+                if len(frames) >= self.chunk_size:
+                    self.flush(serial)
+
+    def flush(self, serial) -> None:
+        """
+        Compress and write the pending frames of a camera.
+        :param serial:      Camera serial number
+        """
+        frames, index = self.chunks.pop(serial, ([], []))
+        if frames:
+            np.savez_compressed(os.path.join(self.folder, f"{serial}_{index[0]:08d}.npz"),
+                                frames=np.stack(frames), index=np.asarray(index, dtype=np.int64))
@@ -0,0 +1,222 @@
+"""
+Session timeline aligning the protocol steps of the audio script with the frames of the recorded video.
+
+During a session, every written frame and some VLC playback times are stamped on the same monotonic clock.
+At the end of the session they are saved next to the video as a small npz index:
+
+    frame_times     float64 (n_frames,)     monotonic time of every written frame, sorted
+    media_anchors   float64 (n_anchors, 2)  (monotonic time, media time in seconds) of the audio script
+    event_names     str (n_events,)         session events (recording start, audio start, ...)
+    event_times     float64 (n_events,)     monotonic time of every event
+    step_names      str (n_steps,)          protocol steps from the timing table
+    step_frames     int64 (n_steps, 2)      first and last (excluded) frame of every step
+
+Since frame_times is sorted, any time can be converted into a frame index with a binary search.
+"""
+import os
+import csv
+import time
+import logging as lg
+import cv2
+import numpy as np
+
+
+def read_timing_table(path):
+    """
+    Read the timing table of the protocol.
+    :param path:        Path to the csv timing table with step,start,end columns
+    :return: List of (step, start, end) tuples sorted by start time, times in seconds of the audio script
+    """
+    steps = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            start, end = float(row["start"]), float(row["end"])
+            if end <= start:
+                raise Warning(f"Invalid interval for step {row['step']}: {start} -> {end}")
+            steps.append((row["step"], start, end))
+
+    return sorted(steps, key=lambda step: step[1])
+
+
+def get_timeline_name(video_file_name) -> str:
+    """
+    Name of the timeline index saved next to a video.
+    :param video_file_name:     Path to the video
+    :return: Path to the index as str
+    """
+    return os.path.splitext(video_file_name)[0] + "_timeline.npz"
+
+
+class Timeline:
+    """
+    Class collecting frame and media timestamps during a session on a shared monotonic clock.
+    Frames are added by the writer thread, media times are sampled from the attached VLC player.
+    """
+
+    def __init__(self, media_period=1.0):
+        """
+        :param media_period:    Minimum interval in seconds between two samples of the player time
+        """
+        self.media_period = media_period
+        self.frame_times = []
+        self.media_anchors = []
+        self.events = []
+        self.player = None
+        self.last_media_sample = 0
+
+    @staticmethod
+    def clock() -> float:
+        """
+        Shared clock of the timeline
+        :return: Monotonic time in seconds
+        """
+        return time.monotonic()
+
+    def add_frame(self, frame_time=None) -> int:
+        """
+        Stamp the next written frame.
+        :param frame_time:      Monotonic time at which the frame has been captured, default to now
+        :return: Index of the frame in the video
+        """
+        frame_time = self.clock() if frame_time is None else frame_time
+        # Frame times must stay sorted for the binary search, but a mosaic made only of substitute frames is stamped
+        # when written, possibly after the capture time of the next real frames
+        if self.frame_times and frame_time < self.frame_times[-1]:
+            frame_time = self.frame_times[-1]
+        self.frame_times.append(frame_time)
+        self.sample_media()
+        return len(self.frame_times) - 1
+
+    def mark(self, name) -> None:
+        """
+        Stamp a session event.
+        :param name:    Name of the event
+        """
+        self.events.append((name, self.clock()))
+
+    def attach_player(self, player) -> None:
+        """
+        Set the VLC player of the audio script to sample its playback time.
+        :param player:  vlc.MediaPlayer
+        """
+        self.player = player
+        self.mark("media_start")
+        self.sample_media(force=True)
+
+    def sample_media(self, force=False) -> None:
+        """
+        Store the current playback time of the player along with the clock time.
+        :param force:   Sample even if the last sample is more recent than media_period
+        """
+        now = self.clock()
+        if self.player is None or (not force and now - self.last_media_sample < self.media_period):
+            return
+        self.last_media_sample = now
+        media_time = self.player.get_time()
+        if media_time >= 0 and self.player.is_playing():
+            self.media_anchors.append((now, media_time / 1000))
+
+    def save(self, path, steps=None) -> None:
+        """
+        Save the timeline as a npz index.
+        :param path:    Output path
+        :param steps:   Optional timing table as returned by read_timing_table, resolved into frames before saving
+        """
+        frame_times = np.asarray(self.frame_times, dtype=np.float64)
+        media_anchors = np.asarray(self.media_anchors, dtype=np.float64).reshape(-1, 2)
+        index = TimelineIndex(frame_times, media_anchors)
+        steps = steps if steps else []
+        np.savez(
+            path,
+            frame_times=frame_times,
+            media_anchors=media_anchors,
+            event_names=np.asarray([name for name, _ in self.events], dtype=str),
+            event_times=np.asarray([t for _, t in self.events], dtype=np.float64),
+            step_names=np.asarray([step for step, _, _ in steps], dtype=str),
+            step_frames=np.asarray([index.media_to_frames(start, end) for _, start, end in steps],
+                                   dtype=np.int64).reshape(-1, 2)
+        )
+        lg.info(f"Timeline saved as {path}")
+
+
+class TimelineIndex:
+    """
+    Read-only view of a saved timeline used to seek directly to protocol steps.
+    """
+
+    def __init__(self, frame_times, media_anchors, step_names=None, step_frames=None):
+        self.frame_times = frame_times
+        self.media_anchors = media_anchors
+        self.steps = {}
+        if step_names is not None:
+            self.steps = {str(name): (int(first), int(last)) for name, (first, last) in zip(step_names, step_frames)}
+
+    @classmethod
+    def load(cls, video_file_name):
+        """
+        Load the timeline saved next to a video.
+        :param video_file_name:     Path to the video
+        :return: TimelineIndex or None if the video has no timeline
+        """
+        path = get_timeline_name(video_file_name)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data["frame_times"], data["media_anchors"], data["step_names"], data["step_frames"])
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.frame_times)
+
+    def time_to_frame(self, clock_time) -> int:
+        """
+        Binary search of the first frame captured at or after a clock time.
+        :param clock_time:      Monotonic time
+        :return: Frame index, clipped to the video length
+        """
+        return min(int(np.searchsorted(self.frame_times, clock_time)), self.frame_count)
+
+    def media_to_clock(self, media_time) -> float:
+        """
+        Convert a time of the audio script into clock time using the closest media anchor.
+        Without anchors, the audio is assumed to have started with the first frame.
+        :param media_time:      Time in seconds in the audio script
+        :return: Monotonic time
+        """
+        if not len(self.media_anchors):
+            return (self.frame_times[0] if self.frame_count else 0) + media_time
+        idx = int(np.searchsorted(self.media_anchors[:, 1], media_time))
+        idx = min(max(idx - 1, 0), len(self.media_anchors) - 1)
+        anchor_clock, anchor_media = self.media_anchors[idx]
+
+        return anchor_clock + media_time - anchor_media
+
+    def media_to_frames(self, start, end):
+        """
+        Convert an interval of the audio script into frames.
+        :param start:       Start of the interval in seconds of the audio script
+        :param end:         End of the interval in seconds of the audio script
+        :return: (first, last) frames, last excluded
+        """
+        return self.time_to_frame(self.media_to_clock(start)), self.time_to_frame(self.media_to_clock(end))
+
+    def resolve_steps(self, steps):
+        """
+        Resolve a timing table into frames, using the steps saved in the index when available.
+        :param steps:   List of (step, start, end) tuples as returned by read_timing_table
+        :return: List of (step, first, last) tuples, last frame excluded
+        """
+        return [(step, *self.steps.get(step, self.media_to_frames(start, end))) for step, start, end in steps]
+
+    def seek(self, capture, step) -> int:
+        """
+        Move an OpenCV capture to the first frame of a protocol step.
+        The decoder restarts from the closest previous keyframe, without decoding the beginning of the video.
+        :param capture:     cv2.VideoCapture opened on the video of this timeline
+        :param step:        Name of a step saved in the index
+        :return: Index of the frame that will be read next
+        """
+        first, _ = self.steps[step]
+        capture.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+        return first
@@ -5,11 +5,16 @@ import os
 import time
 import logging as lg
 from pathlib import Path
+from typing import TYPE_CHECKING
 import cv2
-import vlc
 import pyrealsense2 as rs2
 from utils.thread_read import ReaderRealSense
 from utils.thread_write import Writer
+from utils.mosaic import get_mosaic_size
+
+if TYPE_CHECKING:
+    # VLC is slow to import, it is only imported at runtime when a media is played
+    import vlc
 
 
 def get_cameras_id():
@@ -44,7 +49,8 @@ def check_path(path) -> None:
         os.mkdir(path)
 
 
-def create_writer(output_prefix, output_folder, cam_number, cam_fps, input_width, input_height):
+def create_writer(output_prefix, output_folder, cam_number, cam_fps, input_width, input_height, timeline=None,
+                  steps=None, depth=False):
     """
     Create a thread object for video writing to speed up writing frames.
     :param output_prefix:       Prefix for the output name
@@ -53,32 +59,37 @@ def create_writer(output_prefix, output_folder, cam_number, cam_fps, input_width
     :param cam_fps:             Input video FPS
     :param input_width:         Width of the input video
     :param input_height:        Height of the input video
+    :param timeline:            Optional Timeline stamping every written frame
+    :param steps:               Optional timing table resolved into frames when saving the timeline
+    :param depth:               Whether to also write the depth frames given with every mosaic
     :return: Video writer in separate thread
     """
 
     output_name = set_output_name(output_prefix, output_folder)
-    # Double the width for the output as each NIR + RGB is stacked horizontally
-    writer_width = input_width * 2
-    # Triple the height as each RGB + NIR is stacked vertically
-    writer_height = input_height * cam_number
-    writer = Writer(output_name, cam_fps, writer_width, writer_height)
+    writer_width, writer_height = get_mosaic_size(cam_number, input_width, input_height)
+    writer = Writer(output_name, cam_fps, writer_width, writer_height, timeline, steps, depth)
 
     return writer
 
 
-def start_readers(cams, input_width, input_height, cam_fps):
+def start_readers(cams, input_width, input_height, cam_fps, stall_fill="repeat", queue_size=64, depth=False):
     """
     Start one thread for each cameras to speed up reading frames
     :param cams:                List of RealSense cameras serial number
     :param input_width:         Width of the input image
     :param input_height:        Height of the input image
     :param cam_fps:             FPS of the input camera
+    :param stall_fill:          Substitute frame of a stalled camera, repeat or blank
+    :param queue_size:          Maximum number of frames queued by each reader
+    :param depth:               Whether to also capture depth
 
     :return: Dict of camera reading threads
     """
     readers = {}
     for cam in cams:
-        readers[f"reader{cam}"] = ReaderRealSense(cam, input_width, input_height, cam_fps).start()
+        readers[f"reader{cam}"] = ReaderRealSense(cam, input_width, input_height, cam_fps,
+                                                   stall_fill=stall_fill, queue_size=queue_size,
+                                                   depth=depth).start()
     readers = synchronize_readers(readers)
 
     return readers
@@ -113,12 +124,34 @@ def set_output_name(output_prefix, output_folder) -> str:
     return output_name
 
 
+def realign_readers(readers) -> None:
+    """
+    Realign cameras once a camera delivers frames again after substitute frames.
+    While substitute frames were waited for, the other cameras were read slower than they produce and their queues
+    filled up. Their frames captured before the first frame of the resumed camera are dropped, otherwise these cameras
+    would stay behind for the rest of the recording.
+    :param readers:     Dict of video readers
+    """
+    resumed = [reader for reader in readers.values() if reader.resume_time is not None]
+    if not resumed:
+        return
+    resume_time = max(reader.resume_time for reader in resumed)
+    for reader in resumed:
+        reader.resume_time = None
+    # Keep frames captured within half a frame period of the resumed camera
+    dropped = {reader.serial_number: reader.drop_frames_before(resume_time - 0.5 / reader.fps)
+               for reader in readers.values()}
+    lg.warning(f"Cameras {', '.join(reader.serial_number for reader in resumed)} resumed, cameras realigned by "
+               f"dropping stale frames: " + ", ".join(f"{serial}: {count}" for serial, count in dropped.items()))
+
+
 def get_frames_concat(readers):
     """
     Get all frames from every thread and concatenate them into one single frame.
     :param readers:     Dict of video readers
     :return: OpenCV image
     """
+    realign_readers(readers)
     camera_frames = []
 
     # Read every reader frame
@@ -130,35 +163,60 @@ def get_frames_concat(readers):
     return frames_concat
 
 
-def record(readers, writer) -> None:
+def get_depth_frames(readers):
+    """
+    Get the depth frames matching the last frames read from every reader.
+    :param readers:     Dict of video readers
+    :return: Dict of camera serial to uint16 depth frame, None if depth is disabled
+    """
+    depth_frames = {reader.serial_number: reader.depth_frame for reader in readers.values() if reader.depth}
+
+    return depth_frames if depth_frames else None
+
+
+def get_capture_time(readers):
+    """
+    Get the capture time of the last frames read from every reader.
+    :param readers:     Dict of video readers
+    :return: Monotonic time of the oldest frame of the mosaic, None if every frame is a substitute frame
+    """
+    frame_times = [reader.frame_time for reader in readers.values() if reader.frame_time is not None]
+
+    return min(frame_times) if frame_times else None
+
+
+def record(readers, writer, stop_event=None) -> None:
     """
     Simply record directly concatenated images from readers with the writer.
 
     :param readers:     Camera reader threads
     :param writer:      Video Writer thread
+    :param stop_event:  Optional threading.Event stopping the recording when set, used when recording in a thread
     """
     # Start writer
     writer = writer.start()
 
-    while True:
+    while stop_event is None or not stop_event.is_set():
         try:
             # Get every frame of every camera into a single huge frame
             frames_concat = get_frames_concat(readers)
             # Write this frame in the output video
-            writer.write_frame(frames_concat)
+            writer.write_frame(frames_concat, get_depth_frames(readers), get_capture_time(readers))
         except KeyboardInterrupt:
             writer.stop()
             stop_readers(readers)
             break
 
 
-def play_vlc(path: str, wait: bool) -> vlc.MediaPlayer:
+def play_vlc(path: str, wait: bool) -> "vlc.MediaPlayer":
     """
-    Read media using VLC
+    Read media using VLC. VLC is only imported when a media is played.
 
     :param path:    Path to the media
     :param wait:    Whether to wait for the player to end
     """
+    import vlc
+
     player = vlc.MediaPlayer()
     media = vlc.Media(path)
     player.set_media(media)
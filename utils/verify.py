@@ -0,0 +1,199 @@
+"""
+Standalone script that checks the integrity of recorded sessions without decoding whole videos.
+
+For every mosaic of a folder:
+  * container metadata is read first: unreadable files, mosaic sizes not matching the input size and frame counts
+    differing from the capture-side counters (timeline index and catalog) are reported,
+  * the last frame is decoded to detect truncated files,
+  * a few frames spread over the video are decoded, and every tile of the mosaic is flagged as blank when it has almost
+    no contrast, or frozen when it does not change between two samples.
+
+Videos are spread across a process pool:
+
+    python -m utils.verify videos/ -iw 1280 -ih 720
+"""
+import os
+import sys
+import argparse
+import logging as lg
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+import numpy as np
+from utils.mosaic import get_cam_number, check_mosaic_width, MODALITIES
+from utils.timeline import TimelineIndex
+from utils.catalog import get_session_by_video
+
+# Pixel stride used to compute tile statistics, 1/16 of the pixels is enough for contrast and change detection
+STRIDE = 4
+
+
+def read_frame(capture, frame_idx):
+    """
+    Decode a single frame.
+    :param capture:     cv2.VideoCapture
+    :param frame_idx:   Index of the frame
+    :return: OpenCV image or None if it cannot be decoded
+    """
+    capture.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    ret, frame = capture.read()
+
+    return frame if ret else None
+
+
+def get_tile_pixels(frames, cam_number):
+    """
+    Split subsampled mosaics into flat tiles.
+    :param frames:          Array of mosaics of shape (samples, height, width, 3)
+    :param cam_number:      Number of cameras in the mosaics
+    :return: Array of shape (samples, tiles, pixels), tiles ordered as utils.mosaic.get_tiles
+    """
+    samples, height, width, channels = frames.shape
+    tiles = frames.reshape(samples, cam_number, height // cam_number, len(MODALITIES), width // len(MODALITIES),
+                           channels)
+
+    return tiles.transpose(0, 1, 3, 2, 4, 5).reshape(samples, cam_number * len(MODALITIES), -1)
+
+
+def get_tile_flags(frames, cam_number, blank_spread=4, blank_percentile=5, frozen_diff=0.5):
+    """
+    Vectorized statistics of every tile of every sampled mosaic.
+    A tile is blank when the spread between its low and high percentiles is small, so that a few marked pixels such
+    as the NO SIGNAL text of a stalled camera do not hide it.
+    :param frames:              Array of mosaics of shape (samples, height, width, 3)
+    :param cam_number:          Number of cameras in the mosaics
+    :param blank_spread:        Spread between the percentiles under which a tile is considered blank
+    :param blank_percentile:    Percentage of the darkest and of the brightest values ignored by the spread
+    :param frozen_diff:         Mean absolute difference under which a tile is considered frozen between two samples
+    :return: (blank, frozen) boolean arrays of shapes (samples, tiles) and (samples - 1, tiles)
+    """
+    pixels = get_tile_pixels(frames, cam_number).astype(np.int16)
+    low, high = np.percentile(pixels, [blank_percentile, 100 - blank_percentile], axis=2)
+    blank = high - low < blank_spread
+    frozen = np.abs(np.diff(pixels, axis=0)).mean(axis=2) < frozen_diff
+
+    return blank, frozen
+
+
+def verify_video(video_path, input_width, input_height, samples=16, catalog=None):
+    """
+    Check one mosaic. This function is called in a separated process.
+    :param video_path:      Path to the mosaic
+    :param input_width:     Width of every single video stream
+    :param input_height:    Height of every single video stream
+    :param samples:         Number of frames decoded for tile statistics
+    :param catalog:         Path to the SQLite catalog, None to skip the comparison with the catalog
+    :return: List of issues as str, empty if the video is valid
+    """
+    cv2.setNumThreads(1)
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        return ["unreadable container, the file is probably truncated"]
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    mosaic_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    mosaic_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    issues = []
+
+    if frame_count <= 0:
+        capture.release()
+        return ["no frame in container"]
+
+    # Tiles cannot be located in a mosaic of unexpected size
+    try:
+        check_mosaic_width(mosaic_width, input_width)
+        cam_number = get_cam_number(mosaic_height, input_height)
+    except Warning as e:
+        capture.release()
+        return [str(e)]
+
+    # Compare with capture-side counters
+    index = TimelineIndex.load(video_path)
+    if index is not None and index.frame_count != frame_count:
+        issues.append(f"{frame_count} frames in container, {index.frame_count} written according to the timeline")
+    session = get_session_by_video(catalog, video_path) if catalog else None
+    if session is not None and session["frame_count"] != frame_count:
+        issues.append(f"{frame_count} frames in container, {session['frame_count']} according to the catalog")
+    if session is not None and session["depth_folder"]:
+        if not os.path.isdir(session["depth_folder"]):
+            issues.append(f"depth folder {session['depth_folder']} is missing")
+        if session["depth_dropped_frames"]:
+            issues.append(f"depth of {session['depth_dropped_frames']} frames dropped while recording")
+
+    if read_frame(capture, frame_count - 1) is None:
+        issues.append(f"last frame {frame_count - 1} cannot be decoded, the file is probably truncated")
+
+    # Decode a few frames spread over the video, subsampled right away to keep memory low
+    frames = []
+    for frame_idx in np.linspace(0, frame_count - 1, min(samples, frame_count)).astype(int):
+        frame = read_frame(capture, frame_idx)
+        if frame is None:
+            issues.append(f"frame {frame_idx} cannot be decoded")
+            continue
+        frames.append(frame[::STRIDE, ::STRIDE])
+    capture.release()
+    if not frames:
+        return issues
+
+    blank, frozen = get_tile_flags(np.stack(frames), cam_number)
+    for tile in range(blank.shape[1]):
+        name = f"cam{tile // len(MODALITIES)}_{MODALITIES[tile % len(MODALITIES)]}"
+        if blank[:, tile].any():
+            issues.append(f"{name} blank in {blank[:, tile].sum()}/{blank.shape[0]} samples")
+        if frozen.shape[0] and frozen[:, tile].any():
+            issues.append(f"{name} frozen between {frozen[:, tile].sum()}/{frozen.shape[0]} consecutive samples")
+
+    return issues
+
+
+def verify_folder(input_folder, input_width, input_height, samples=16, catalog=None, workers=None) -> int:
+    """
+    Check every mosaic of a folder using a process pool.
+    :param input_folder:    Folder containing the mosaics as mp4
+    :param input_width:     Width of every single video stream
+    :param input_height:    Height of every single video stream
+    :param samples:         Number of frames decoded per video
+    :param catalog:         Path to the SQLite catalog, None to skip the comparison with the catalog
+    :param workers:         Number of processes, defaults to the number of cores
+    :return: Number of invalid videos
+    """
+    videos = sorted(str(path) for path in Path(input_folder).glob("*.mp4"))
+    invalid = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(verify_video, video, input_width, input_height, samples, catalog): video
+                   for video in videos}
+        for future in as_completed(futures):
+            video = futures[future]
+            try:
+                issues = future.result()
+            except Exception as e:
+                issues = [f"verification failed: {e}"]
+            if issues:
+                invalid += 1
+                lg.error(f"{video}: " + "; ".join(issues))
+            else:
+                lg.info(f"{video}: OK")
+    lg.info(f"{len(videos) - invalid}/{len(videos)} valid videos")
+
+    return invalid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the integrity of recorded mosaics.")
+    parser.add_argument("input_folder", help="Folder containing the recorded mosaics.")
+    parser.add_argument("--input-width", "-iw", type=int, default=1280, help="Width of every single video stream.")
+    parser.add_argument("--input-height", "-ih", type=int, default=720, help="Height of every single video stream.")
+    parser.add_argument("--samples", type=int, default=16, help="Number of frames decoded per video.")
+    parser.add_argument("--catalog", help="SQLite catalog to compare frame counts with. "
+                                          "Default to catalog.sqlite in the input folder if it exists.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes. Default to the core count.")
+    parser.add_argument("--verbose", "-v", help="Run the code in verbose mode.", action='store_true')
+    args = parser.parse_args()
+
+    lg.basicConfig(level=lg.DEBUG if args.verbose else lg.INFO)
+
+    catalog = args.catalog
+    if catalog is None and os.path.exists(Path(args.input_folder) / "catalog.sqlite"):
+        catalog = str(Path(args.input_folder) / "catalog.sqlite")
+
+    sys.exit(1 if verify_folder(args.input_folder, args.input_width, args.input_height, args.samples, catalog,
+                                args.workers) else 0)
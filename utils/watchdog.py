@@ -0,0 +1,58 @@
+"""
+Watchdog restarting stalled cameras without stopping the recording.
+"""
+import time
+import logging as lg
+from threading import Thread
+
+
+class CameraWatchdog:
+    """
+    Class that periodically checks the age of the last frame of every reader with a dedicated thread.
+    A reader whose last frame is older than the stall timeout gets its pipeline restarted in the background,
+    while the other cameras keep recording.
+    """
+
+    def __init__(self, readers, stall_timeout=2., period=0.5):
+        """
+        :param readers:         Dict of ReaderRealSense
+        :param stall_timeout:   Age in seconds of the last frame after which a camera is restarted
+        :param period:          Interval in seconds between two checks
+        """
+        self.readers = readers
+        self.stall_timeout = stall_timeout
+        self.period = period
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the thread checking readers
+        :return: CameraWatchdog class
+        """
+        self.thread = Thread(target=self.watch, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Set to TRUE the stopped attribute to stop de main loop
+        """
+        self.stopped = True
+
+    def watch(self):
+        """
+        Loop until the thread stop to restart stalled readers
+        """
+        while not self.stopped:
+            time.sleep(self.period)
+            for reader in self.readers.values():
+                if reader.reconnecting or reader.stopped:
+                    continue
+                age = time.monotonic() - reader.last_frame_time
+                if age > self.stall_timeout:
+                    lg.warning(f"Camera {reader.serial_number} stalled for {age:.2f}s, restarting it")
+                    # Flag it now so that the next check does not start a second restart
+                    reader.reconnecting = True
+                    Thread(target=reader.restart, args=(), daemon=True).start()